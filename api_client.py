@@ -1,100 +1,364 @@
 """
 API client for Hasaki with retry logic
 """
+import copy
+import json
+import os
 import time
 import random
+import socket
+import threading
+import httpx
+import orjson
+from urllib.parse import urlparse
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from typing import Dict, List, Optional, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
+from itertools import islice
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional, Any
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from logger import setup_logger
 from config import Config
 
 
+# DNS cache cho Hasaki hosts: {getaddrinfo args: (expires_at, result)}
+# urllib3/httpx gọi getaddrinfo mỗi lần mở connection mới → cache để không resolve lại hasaki.vn
+# Hosts khác (Supabase...) đi thẳng resolver gốc; tối đa DNS_CACHE_MAXSIZE entries
+_dns_cache: "OrderedDict[tuple, tuple[float, Any]]" = OrderedDict()
+_dns_cache_lock = threading.Lock()
+_dns_cache_hosts: frozenset = frozenset()
+_original_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(*args, **kwargs):
+    """socket.getaddrinfo với TTL cache (Config.DNS_CACHE_TTL) cho Hasaki hosts; lỗi resolve không bị cache"""
+    host = args[0] if args else kwargs.get('host')
+    if host not in _dns_cache_hosts:
+        return _original_getaddrinfo(*args, **kwargs)
+    
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.time()
+    
+    with _dns_cache_lock:
+        entry = _dns_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    
+    result = _original_getaddrinfo(*args, **kwargs)
+    with _dns_cache_lock:
+        _dns_cache[key] = (now + Config.DNS_CACHE_TTL, result)
+        _dns_cache.move_to_end(key)
+        while len(_dns_cache) > Config.DNS_CACHE_MAXSIZE:
+            _dns_cache.popitem(last=False)
+    return result
+
+
+def install_dns_cache():
+    """
+    Patch socket.getaddrinfo một lần cho cả process (idempotent) - gọi 1 lần lúc startup (main)
+    Chỉ cache hosts của các Hasaki API trong Config
+    """
+    global _dns_cache_hosts
+    _dns_cache_hosts = frozenset(
+        urlparse(url).hostname
+        for url in (
+            Config.HASAKI_HOME_API, Config.HASAKI_LISTING_API,
+            Config.HASAKI_PRODUCT_API, Config.HASAKI_REVIEW_API
+        )
+        if url and urlparse(url).hostname
+    )
+    if socket.getaddrinfo is not _cached_getaddrinfo:
+        socket.getaddrinfo = _cached_getaddrinfo
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter
+    AIMD: bị 429 → rate giảm một nửa; mỗi 100 requests thành công → +1 req/s (tối đa max_rate)
+    """
+    
+    RECOVERY_INTERVAL = 100  # Số requests thành công trước mỗi lần tăng rate
+    
+    def __init__(self, rate: float, burst: int, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block tới khi có token (sleep ngoài lock)"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def on_throttled(self):
+        """Server trả 429 → giảm rate một nửa"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._successes = 0
+    
+    def on_success(self):
+        """Request thành công → tăng dần rate lại sau khi bị giảm"""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.RECOVERY_INTERVAL:
+                self.rate = min(self.max_rate, self.rate + 1)
+                self._successes = 0
+
+
 class HasakiAPIClient:
     """Client for Hasaki API with proper retry and rate limiting"""
     
+    DEFAULT_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+        'Accept': 'application/json',
+        'Accept-Language': 'vi-VN,vi;q=0.9,en;q=0.8',
+    }
+    REVIEW_PAGE_SIZE = 5          # Hasaki API trả 5 reviews/page
+    LISTING_PAGE_SIZE = 12        # product_list_limit=12 trong HASAKI_LISTING_API
+    REVIEW_PREFETCH = 8           # Review pages in-flight tối đa / product
+    _PAGE_MARKER = "\x00page\x00"  # Placeholder page khi pre-format URL template
+    # Thông tin listing page lưu kèm validators → dùng lại khi page trả 304
+    # rows: (product_id, brand_id) của page do caller gắn vào metadata (crawl_listings) trước commit_validators
+    PAGE_INFO_KEYS = ('rows', 'total_pages')
+    
     def __init__(self):
         self.config = Config()
         self.logger = setup_logger()
         self.session = self._create_session()
+        self.http2_client = self._create_http2_client()
         self.request_count = 0
+        self.request_seconds = 0.0  # Tổng latency của requests thành công (không tính chờ rate limit)
+        
+        # TTL cache cho idempotent GETs: {url: (stored_at, (data, metadata))}
+        self._cache: OrderedDict[str, tuple[float, tuple[Any, Optional[Dict[str, Any]]]]] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        # HTTP validators cho conditional GET: {url: {'etag': ..., 'last_modified': ...}}
+        self._validators: Dict[str, Dict[str, str]] = {}
+        self._validators_lock = threading.Lock()
+        self.not_modified_count = 0
+        
+        # Giới hạn số requests đồng thời tới Hasaki (tất cả workers + page fan-out)
+        self._request_slots = threading.BoundedSemaphore(self.config.MAX_CONCURRENT_REQUESTS)
+        # Giới hạn tốc độ requests (req/s) tới Hasaki
+        self.rate_limiter = TokenBucket(self.config.REQ_PER_SEC, self.config.REQ_BURST)
+        self.throttled_count = 0
+        self.error_count = 0  # Lỗi transient (5xx, connection reset, timeout) kể cả lần được retry
+        
+        # 1 pool dùng chung cho page fan-out (listing + review pages) thay vì
+        # tạo/hủy ThreadPoolExecutor mỗi category/product
+        self._page_executor = ThreadPoolExecutor(
+            max_workers=self.config.MAX_CONCURRENT_REQUESTS,
+            thread_name_prefix="hasaki-page"
+        )
+        
+        # Request coalescing: 1 in-flight request per URL, các threads khác chờ cùng Future
+        self._inflight: Dict[tuple[str, bool, bool], Future] = {}  # {(url, with_meta, conditional): Future}
+        self._inflight_lock = threading.Lock()
     
     def _create_session(self) -> requests.Session:
         """Create session with retry strategy"""
         session = requests.Session()
         
+        # Không retry 429 / 503 ở urllib3: _fetch phải thấy 2 status này để TokenBucket giảm rate (AIMD)
+        # rồi tự chờ Retry-After (giới hạn MAX_RETRY_AFTER) → listing / product detail giống reviews
         retry_strategy = Retry(
             total=self.config.MAX_RETRIES,
             backoff_factor=0.5,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["GET"]
+            status_forcelist=[500, 502, 504],
+            allowed_methods=["GET"],
+            respect_retry_after_header=False  # Retry-After do _fetch xử lý (có giới hạn)
         )
         
         adapter = HTTPAdapter(
             max_retries=retry_strategy,
-            pool_connections=30,
-            pool_maxsize=50
+            pool_connections=self.config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=self.config.HTTP_POOL_MAXSIZE,
+            pool_block=False  # Pool đầy → mở thêm connection (warning), không block worker
         )
         
         session.mount("http://", adapter)
         session.mount("https://", adapter)
         
         # Headers
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'application/json',
-            'Accept-Language': 'vi-VN,vi;q=0.9,en;q=0.8',
-        })
+        session.headers.update(self.DEFAULT_HEADERS)
+        session.headers['Connection'] = 'keep-alive'
         
         return session
     
+    def _create_http2_client(self) -> httpx.Client:
+        """
+        Create HTTP/2 client cho review pagination
+        Tất cả review pages cùng host/TLS → multiplex nhiều requests trên 1 connection
+        (thread-safe, dùng chung cho tất cả review workers)
+        """
+        return httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=self.config.REQUEST_TIMEOUT,
+            headers=self.DEFAULT_HEADERS
+        )
+    
     def _make_request(
         self, 
         url: str,
-        return_metadata: bool = False
+        return_metadata: bool = False,
+        http2: bool = False,
+        use_cache: bool = False,
+        conditional: bool = False
     ) -> Optional[Dict[str, Any]]:
         """
         Make HTTP request with error handling và track metadata
+        http2=True: gửi qua HTTP/2 client (multiplexed) thay vì requests.Session
+        use_cache=True: dùng TTL cache in-process (chỉ cho idempotent GETs, vd. home API)
+        conditional=True: gửi If-None-Match/If-Modified-Since từ lần crawl trước;
+            304 → data=None, metadata['not_modified']=True (chỉ dùng với return_metadata=True)
+        return_metadata=False: fast path - không đo timing, không build metadata dict
         Returns: response JSON hoặc dict với 'data' và 'metadata' nếu return_metadata=True
         """
+        # Conditional GET cần metadata (validators, not_modified)
+        with_meta = return_metadata or conditional
+        result = self._cache_get(url) if use_cache else None
+        
+        if result is None:
+            headers = self._conditional_headers(url) if conditional else None
+            result = self._fetch_coalesced(url, http2=http2, headers=headers, with_meta=with_meta)
+            if result is None:
+                return None
+            if use_cache:
+                self._cache_set(url, result)
+        
+        data, metadata = result
+        if return_metadata:
+            return {'data': data, 'metadata': metadata}
+        return data
+    
+    def _fetch_coalesced(
+        self,
+        url: str,
+        http2: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+        with_meta: bool = True
+    ) -> Optional[tuple[Any, Optional[Dict[str, Any]]]]:
+        """
+        Dedupe in-flight identical GETs
+        Thread đầu tiên thực hiện request, các thread cùng URL chờ kết quả của nó
+        (kết quả dùng chung - caller không được sửa data)
+        Key gồm cả conditional (có headers validators): request thường không nhận nhầm 304/None
+        """
+        key = (url, with_meta, headers is not None)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._inflight[key] = future
+        
+        if not is_owner:
+            return future.result()
+        
+        try:
+            result = self._fetch(url, http2=http2, headers=headers, with_meta=with_meta)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+    
+    def _fetch(
+        self,
+        url: str,
+        http2: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+        with_meta: bool = True
+    ) -> Optional[tuple[Any, Optional[Dict[str, Any]]]]:
+        """
+        Execute GET with retry
+        with_meta=False: bỏ qua timing + metadata dict (caller không dùng)
+        Returns: (data, metadata | None) hoặc None nếu thất bại
+        """
+        client = self.http2_client if http2 else self.session
         # Retry logic for socket errors (WinError 10035)
         max_retries = 3
-        last_error = None
         
         for attempt in range(max_retries):
             try:
-                start_time = time.time()
-                response = self.session.get(
-                    url,
-                    timeout=self.config.REQUEST_TIMEOUT
-                )
-                response_time_ms = int((time.time() - start_time) * 1000)
+                self.rate_limiter.acquire()
+                with self._request_slots:
+                    start_time = time.perf_counter()
+                    response = client.get(
+                        url,
+                        headers=headers,
+                        timeout=self.config.REQUEST_TIMEOUT
+                    )
+                    elapsed = time.perf_counter() - start_time
+                
+                if response.status_code == 429:
+                    self.throttled_count += 1
+                    self.rate_limiter.on_throttled()
+                
+                # Rate limited: chờ đúng Retry-After server gợi ý (+ jitter) rồi retry
+                if response.status_code in (429, 503) and attempt < max_retries - 1:
+                    delay = self._retry_after_delay(response)
+                    self.logger.debug("HTTP %s, retry after %.2fs: %s", response.status_code, delay, url)
+                    time.sleep(delay)
+                    continue
                 
                 response.raise_for_status()
                 self.request_count += 1
+                self.request_seconds += elapsed
+                self.rate_limiter.on_success()
                 
-                data = response.json()
-                
-                if return_metadata:
-                    return {
-                        'data': data,
-                        'metadata': {
-                            'http_status': response.status_code,
-                            'response_time_ms': response_time_ms,
-                            'request_url': url
-                        }
+                metadata = None
+                if with_meta:
+                    metadata = {
+                        'http_status': response.status_code,
+                        'response_time_ms': int(elapsed * 1000),
+                        'request_url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')
                     }
                 
-                return data
+                # 304 Not Modified: header-only response, không có body để parse
+                if response.status_code == 304:
+                    self.not_modified_count += 1
+                    if metadata is not None:
+                        metadata['not_modified'] = True
+                    return None, metadata
+                
+                # orjson (C extension) parse nhanh hơn stdlib json 2-5x, trả về dict/list như cũ
+                try:
+                    data = orjson.loads(response.content)
+                except orjson.JSONDecodeError:
+                    data = response.json()
+                
+                return data, metadata
             
-            except (requests.exceptions.RequestException, OSError, ConnectionError) as e:
-                last_error = e
+            except (requests.exceptions.RequestException, httpx.HTTPError, OSError, ConnectionError, ValueError) as e:
+                self.error_count += 1
                 # Retry on socket/connection errors
                 if attempt < max_retries - 1:
-                    time.sleep(0.05 * (attempt + 1))  # Small delay: 50ms, 100ms, 150ms
+                    self._sleep_backoff(attempt)
                     continue
                 else:
                     # Final attempt failed
@@ -103,12 +367,124 @@ class HasakiAPIClient:
         
         return None
     
+    def _retry_after_delay(self, response: Any) -> float:
+        """
+        Parse Retry-After header (seconds hoặc HTTP-date) + jitter 0-200ms
+        Không có header → mặc định 1s; giới hạn bởi Config.MAX_RETRY_AFTER
+        """
+        retry_after = response.headers.get('Retry-After')
+        delay = 1.0
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    delay = retry_at.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        
+        delay = min(max(delay, 0.0), self.config.MAX_RETRY_AFTER)
+        return delay + random.random() * 0.2
+    
+    @staticmethod
+    def _sleep_backoff(attempt: int, base: float = 0.1, cap: float = 1.0):
+        """
+        Exponential backoff + jitter (±50%): ~100ms, 200ms, 400ms... tối đa 1s
+        Jitter để retries của nhiều workers không dồn cùng lúc (thundering herd)
+        """
+        delay = min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+        time.sleep(delay)
+    
+    def _conditional_headers(self, url: str) -> Optional[Dict[str, str]]:
+        """Build If-None-Match / If-Modified-Since headers từ validators đã lưu"""
+        validators = self._validators.get(url)
+        if not validators:
+            return None
+        
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers or None
+    
+    def commit_validators(self, metadata: Optional[Dict[str, Any]]):
+        """
+        Lưu ETag/Last-Modified của response (metadata['request_url']) để lần crawl sau gửi conditional GET
+        Caller chỉ gọi SAU KHI đã lưu DB thành công: lưu sớm + store lỗi → lần sau 304 → update bị mất
+        """
+        if not metadata or not metadata.get('request_url'):
+            return
+        validators = {
+            key: metadata[key]
+            for key in ('etag', 'last_modified')
+            if metadata.get(key)
+        }
+        if validators:
+            validators.update(
+                (key, metadata[key]) for key in self.PAGE_INFO_KEYS if metadata.get(key)
+            )
+            with self._validators_lock:
+                self._validators[metadata['request_url']] = validators
+    
+    def load_validators(self):
+        """Load ETag/Last-Modified validators từ lần crawl trước (Config.HTTP_VALIDATORS_FILE)"""
+        path = self.config.HTTP_VALIDATORS_FILE
+        try:
+            if not path.exists():
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                self._validators = json.load(f)
+            self.logger.debug(f"Loaded {len(self._validators)} HTTP validators from {path}")
+        except Exception as e:
+            self.logger.warning(f"Failed to load HTTP validators: {e}")
+            self._validators = {}
+    
+    def save_validators(self):
+        """Persist ETag/Last-Modified validators cho lần crawl sau (ghi file tạm rồi os.replace - atomic)"""
+        path = self.config.HTTP_VALIDATORS_FILE
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._validators_lock:
+                snapshot = dict(self._validators)
+            tmp_path = path.with_suffix(path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.logger.warning(f"Failed to save HTTP validators: {e}")
+    
+    def _cache_get(self, url: str) -> Optional[tuple[Any, Optional[Dict[str, Any]]]]:
+        """Lấy response từ TTL cache (deep copy để caller không sửa bản cache)"""
+        with self._cache_lock:
+            entry = self._cache.get(url)
+            if entry is None:
+                return None
+            
+            stored_at, result = entry
+            if time.time() - stored_at > self.config.CACHE_TTL:
+                del self._cache[url]
+                return None
+            
+            self._cache.move_to_end(url)
+        
+        return copy.deepcopy(result)
+    
+    def _cache_set(self, url: str, result: tuple[Any, Optional[Dict[str, Any]]]):
+        """Lưu response vào TTL cache, evict LRU khi vượt CACHE_MAXSIZE"""
+        with self._cache_lock:
+            self._cache[url] = (time.time(), copy.deepcopy(result))
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.config.CACHE_MAXSIZE:
+                self._cache.popitem(last=False)
+    
     def get_home(self) -> tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
         """
         Fetch home page data
         Returns: (home_data, metadata_dict)
         """
-        result = self._make_request(self.config.HASAKI_HOME_API, return_metadata=True)
+        result = self._make_request(self.config.HASAKI_HOME_API, return_metadata=True, use_cache=True)
         if not result:
             return None, None
         
@@ -119,7 +495,7 @@ class HasakiAPIClient:
         Fetch all categories from home API
         Returns: (full_response_data, metadata_dict)
         """
-        result = self._make_request(self.config.HASAKI_HOME_API, return_metadata=True)
+        result = self._make_request(self.config.HASAKI_HOME_API, return_metadata=True, use_cache=True)
         if not result:
             return None, None
         
@@ -128,43 +504,185 @@ class HasakiAPIClient:
     def get_product_ids_from_category(
         self,
         category_id: int,
-        category_name: str
+        category_name: str,
+        conditional: bool = False,
+        max_pages: Optional[int] = None
     ) -> List[tuple[Dict[str, Any], Dict[str, Any]]]:
         """
         Get all products from a category
-        Returns: List of tuples (listing_data, metadata)
+        max_pages: chỉ lấy N pages đầu (vd. find_brands chỉ cần page 1), None = tất cả
+        Returns: List of tuples (listing_data, metadata) - xem iter_category_pages
         """
-        all_listings = []
-        page = 1
+        return list(self.iter_category_pages(category_id, conditional=conditional, max_pages=max_pages))
+    
+    def iter_category_pages(
+        self,
+        category_id: int,
+        conditional: bool = False,
+        max_pages: Optional[int] = None
+    ) -> Iterator[tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Yield từng listing page của category theo thứ tự page
+        Caller xử lý xong page nào thì page đó được giải phóng (không giữ cả category trong RAM)
         
-        while True:
-            url = self.config.HASAKI_LISTING_API.format(category_id, page)
-            result = self._make_request(url, return_metadata=True)
-            
-            if not result:
-                break
-            
-            data = result['data']
-            metadata = result['metadata']
-            
-            listings = data.get("listing", [])
-            if not listings:
+        Strategy:
+        1. Fetch page 1, đọc tổng số pages từ response (total_page / total)
+        2. Biết tổng số pages → fetch song song pages 2..N (shared page executor)
+           Page 1 trả 304 → dùng total_pages đã lưu kèm validators page 1 (page 1 không đổi)
+        3. Không biết → crawl tuần tự tới page rỗng
+        
+        conditional=True: gửi ETag/Last-Modified của lần crawl trước; page trả 304
+        (không đổi) được yield dạng (None, metadata) rồi tiếp tục sang page sau
+        (chỉ page có listing mới được lưu validators nên 304 = page vẫn còn data)
+        Validators không tự lưu: caller gọi commit_validators(metadata) sau khi insert thành công
+        
+        max_pages: không request pages sau page max_pages (None = tới hết category)
+        
+        Yields: (listing_data, metadata) - page đổi; (None, metadata) - page 304,
+        metadata['rows'] = rows của page đã lưu cùng validators lần trước
+        """
+        url_parts = self._page_url_parts(self.config.HASAKI_LISTING_API, category_id, self._PAGE_MARKER)
+        
+        status, page_result = self._fetch_listing_page(url_parts, 1, conditional)
+        if status in ('failed', 'empty'):
+            return
+        
+        metadata = page_result[1]
+        if status == 'ok':
+            total_pages = self._listing_total_pages(page_result[0])
+            if total_pages:
+                metadata['total_pages'] = total_pages  # Lưu cùng validators page 1
+        else:
+            total_pages = metadata.get('total_pages')
+        yield page_result
+        page_result = None
+        
+        if max_pages is not None and max_pages <= 1:
+            return
+        
+        if total_pages is None:
+            yield from self._iter_listing_pages_sequential(
+                url_parts, conditional, start_page=2, max_pages=max_pages
+            )
+            return
+        
+        if max_pages is not None:
+            total_pages = min(total_pages, max_pages)
+        
+        if total_pages > 1:
+            page_results = self._page_executor.map(
+                lambda p: self._fetch_listing_page(url_parts, p, conditional),
+                range(2, total_pages + 1)
+            )
+            for status, page_result in page_results:
+                if page_result:
+                    yield page_result
+    
+    def _iter_listing_pages_sequential(
+        self,
+        url_parts: tuple[str, str],
+        conditional: bool,
+        start_page: int = 1,
+        max_pages: Optional[int] = None
+    ) -> Iterator[tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Sequential listing crawl (fallback khi không biết tổng số pages) - stop tại page rỗng/lỗi/max_pages"""
+        page = start_page
+        
+        while max_pages is None or page <= max_pages:
+            status, page_result = self._fetch_listing_page(url_parts, page, conditional)
+            if status in ('failed', 'empty'):
                 break
             
-            # Store full listing response với metadata
-            all_listings.append((data, metadata))
+            if page_result:
+                yield page_result
             page += 1
+    
+    def _fetch_listing_page(
+        self,
+        url_parts: tuple[str, str],
+        page: int,
+        conditional: bool = False
+    ) -> tuple[str, Optional[tuple[Dict[str, Any], Dict[str, Any]]]]:
+        """
+        Fetch 1 listing page
+        url_parts: (prefix, suffix) từ _page_url_parts của category
+        Returns: (status, (data, metadata) | None)
+        status: 'ok' | 'not_modified' (304, data=None) | 'empty' (hết listing) | 'failed'
+        """
+        url = url_parts[0] + str(page) + url_parts[1]
+        # Chỉ gửi conditional GET khi đã lưu rows của page: 304 phải carry forward được rows
+        if conditional and 'rows' not in (self._validators.get(url) or {}):
+            conditional = False
+        result = self._make_request(url, return_metadata=True, conditional=conditional)
+        
+        if not result:
+            return 'failed', None
         
-        return all_listings
+        metadata = result['metadata']
+        if metadata.get('not_modified'):
+            # Page không đổi: kèm thông tin page đã lưu cùng validators lần trước
+            cached = self._validators.get(url) or {}
+            metadata.update((key, cached[key]) for key in self.PAGE_INFO_KEYS if key in cached)
+            return 'not_modified', (None, metadata)
+        
+        data = result['data']
+        listing = data.get("listing", [])
+        if not listing:
+            return 'empty', None
+        
+        return 'ok', (data, metadata)
+    
+    @classmethod
+    def _page_url_parts(cls, template: str, *args, **kwargs) -> tuple[str, str]:
+        """
+        Format URL template 1 lần (page = _PAGE_MARKER) rồi tách quanh page
+        → (prefix, suffix); URL từng page = prefix + str(page) + suffix (không format lại)
+        """
+        prefix, suffix = template.format(*args, **kwargs).split(cls._PAGE_MARKER, 1)
+        return prefix, suffix
     
-    def get_product_detail(self, product_id: int) -> tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    def _listing_total_pages(self, data: Dict[str, Any]) -> Optional[int]:
+        """
+        Tổng số listing pages từ response page 1
+        Ưu tiên field số pages, sau đó tính từ tổng số products; None nếu không có
+        """
+        for key in ('total_page', 'total_pages', 'totalPage'):
+            try:
+                value = int(data.get(key) or 0)
+            except (TypeError, ValueError):
+                continue
+            if value > 0:
+                return value
+        
+        for key in ('total', 'total_count', 'totalCount'):
+            try:
+                value = int(data.get(key) or 0)
+            except (TypeError, ValueError):
+                continue
+            if value > 0:
+                return (value + self.LISTING_PAGE_SIZE - 1) // self.LISTING_PAGE_SIZE
+        
+        return None
+    
+    def get_product_detail(
+        self,
+        product_id: int,
+        return_metadata: bool = False,
+        conditional: bool = False
+    ) -> tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
         """
         Fetch full product detail
-        Returns: (product_data, metadata_dict)
+        conditional=True: gửi ETag/Last-Modified của lần crawl trước (luôn trả metadata)
+            304 → (None, metadata với not_modified=True)
+            Validators không tự lưu: caller gọi commit_validators(metadata) sau khi store thành công
+        Returns: (product_data, metadata_dict) - metadata None nếu return_metadata=False
         """
         url = self.config.HASAKI_PRODUCT_API.format(product_id)
-        result = self._make_request(url, return_metadata=True)
         
+        if not return_metadata and not conditional:
+            return self._make_request(url), None
+        
+        result = self._make_request(url, return_metadata=True, conditional=conditional)
         if not result:
             return None, None
         
@@ -172,46 +690,62 @@ class HasakiAPIClient:
     
     def _fetch_review_page(
         self, 
-        product_id: int, 
+        url_parts: tuple[str, str], 
         page: int
-    ) -> Optional[tuple[Dict[str, Any], Dict[str, Any], int]]:
+    ) -> Optional[tuple[Dict[str, Any], int]]:
         """
         Fetch single review page (helper for parallel crawling)
-        Returns: (data, metadata, page_num) or None if empty
+        url_parts: (prefix, suffix) từ _page_url_parts của product
+        Returns: (data, page_num) or None if empty
         """
-        url = self.config.HASAKI_REVIEW_API.format(product_id=product_id, page=page)
-        result = self._make_request(url, return_metadata=True)
+        url = url_parts[0] + str(page) + url_parts[1]
+        data = self._make_request(url, http2=True)
         
-        if not result:
+        if not data:
             return None
         
-        data = result['data']
-        metadata = result['metadata']
+        reviews, _ = self._extract_reviews(data)
         
-        # API structure: response.data.reviews
-        reviews_data = data.get("data", {})
-        if isinstance(reviews_data, dict):
-            reviews = reviews_data.get("reviews", [])
-        else:
-            reviews = []
-        
-        if not reviews or len(reviews) == 0:
+        if not reviews:
             return None
         
-        return (data, metadata, page)
+        return (data, page)
+    
+    @staticmethod
+    def _extract_reviews(data: Dict[str, Any]) -> tuple[List[Any], int]:
+        """
+        Extract reviews list và total từ review API response
+        API structure: response.data.reviews, response.data.total
+        """
+        reviews_data = data.get("data", {})
+        if isinstance(reviews_data, dict):
+            return reviews_data.get("reviews", []) or [], reviews_data.get("total", 0) or 0
+        return [], 0
     
     def get_product_reviews(
         self,
         product_id: int,
         max_pages: int = 50
-    ) -> List[tuple[Dict[str, Any], Dict[str, Any], int]]:
+    ) -> List[tuple[Dict[str, Any], int]]:
+        """
+        Get all reviews for a product - list wrapper của iter_product_reviews
+        Returns: List of tuples (review_page_data, page_number)
         """
-        Get all reviews for a product (SEQUENTIAL with smart stopping)
+        return list(self.iter_product_reviews(product_id, max_pages))
+    
+    def iter_product_reviews(
+        self,
+        product_id: int,
+        max_pages: int = 50
+    ) -> Iterator[tuple[Dict[str, Any], int]]:
+        """
+        Stream review pages của product (PARALLEL prefetch sau page 1)
+        Caller lưu từng page ngay khi yield → DB insert overlap với HTTP các pages sau
         
         Strategy:
-        1. Crawl pages sequentially (1, 2, 3...)
-        2. Calculate total pages from first response (total / page_size)
-        3. Stop when: empty reviews OR reached calculated pages OR duplicate content
+        1. Fetch page 1, tính tổng số pages từ total (total / page_size)
+        2. Fetch song song pages 2..N (shared page executor), yield theo thứ tự page
+        3. Nếu page 1 không có total → fallback crawl tuần tự với smart stopping
         
         IMPORTANT: Hasaki API BUG - Khi hết reviews, API không trả về rỗng 
         mà lặp lại nội dung trang cuối! Phải dùng total để tính số pages.
@@ -220,73 +754,104 @@ class HasakiAPIClient:
             product_id: Product ID
             max_pages: Maximum pages to crawl (safety limit)
         
-        Returns: List of tuples (review_page_data, metadata, page_number)
+        Yields: (review_page_data, page_number)
         """
-        all_reviews = []
-        page = 1
-        consecutive_failures = 0
-        max_consecutive_failures = 3
-        calculated_max_pages = None
-        PAGE_SIZE = 5  # Hasaki API trả 5 reviews/page
+        url_parts = self._page_url_parts(
+            self.config.HASAKI_REVIEW_API, product_id=product_id, page=self._PAGE_MARKER
+        )
         
-        while page <= max_pages:
-            url = self.config.HASAKI_REVIEW_API.format(product_id=product_id, page=page)
-            result = self._make_request(url, return_metadata=True)
+        data = self._make_request(url_parts[0] + "1" + url_parts[1], http2=True)
+        
+        if not data:
+            # _fetch đã retry với backoff → không đoán tiếp pages sau
+            self.logger.debug("Product %s page 1: Request failed", product_id)
+            return
+        
+        reviews, total_reviews = self._extract_reviews(data)
+        
+        if not reviews:
+            self.logger.debug("Product %s: Empty reviews at page 1", product_id)
+            return
+        
+        yield data, 1
+        del data, reviews
+        
+        if total_reviews <= 0:
+            # Không có total → không biết số pages, crawl tuần tự
+            yield from self._iter_product_reviews_fallback(
+                product_id, url_parts, max_pages, start_page=2
+            )
+            return
+        
+        # Ceiling division; total đã biết → thu hẹp max_pages ngay, không request page thừa
+        calculated_max_pages = min(
+            max_pages,
+            (total_reviews + self.REVIEW_PAGE_SIZE - 1) // self.REVIEW_PAGE_SIZE
+        )
+        # Lazy %-formatting: per-product debug logs không format string khi tắt DEBUG
+        self.logger.debug(
+            "Product %s: %s reviews → %s pages expected",
+            product_id, total_reviews, calculated_max_pages
+        )
+        
+        if calculated_max_pages <= 1:
+            return
+        
+        # Fetch song song pages 2..N, tối đa REVIEW_PREFETCH pages in-flight / product (giữ thứ tự page)
+        # → product nhiều pages không chiếm hết queue của shared page executor, buffer có giới hạn
+        pages = iter(range(2, calculated_max_pages + 1))
+        window = deque(
+            self._page_executor.submit(self._fetch_review_page, url_parts, p)
+            for p in islice(pages, self.REVIEW_PREFETCH)
+        )
+        
+        missing = 0
+        while window:
+            page_result = window.popleft().result()
+            next_page = next(pages, None)
+            if next_page is not None:
+                window.append(self._page_executor.submit(self._fetch_review_page, url_parts, next_page))
             
-            if not result:
-                consecutive_failures += 1
-                self.logger.debug(
-                    f"Product {product_id} page {page}: Request failed "
-                    f"({consecutive_failures}/{max_consecutive_failures})"
-                )
-                if consecutive_failures >= max_consecutive_failures:
-                    self.logger.warning(
-                        f"Product {product_id}: Stopped at page {page} "
-                        f"(consecutive failures: {consecutive_failures})"
-                    )
-                    break
-                page += 1
+            if page_result is None:
+                missing += 1
                 continue
+            yield page_result
+        
+        if missing:
+            self.logger.debug(
+                "Product %s: %s/%s pages failed or empty",
+                product_id, missing, calculated_max_pages - 1
+            )
+    
+    def _iter_product_reviews_fallback(
+        self,
+        product_id: int,
+        url_parts: tuple[str, str],
+        max_pages: int,
+        start_page: int = 1
+    ) -> Iterator[tuple[Dict[str, Any], int]]:
+        """
+        Sequential review crawl (fallback khi page 1 không có total)
+        Stop when: empty reviews OR request failed (đã retry trong _fetch) OR max_pages
+        """
+        page = start_page
+        
+        while page <= max_pages:
+            url = url_parts[0] + str(page) + url_parts[1]
+            data = self._make_request(url, http2=True)
             
-            # Reset counter khi thành công
-            consecutive_failures = 0
-            
-            data = result['data']
-            metadata = result['metadata']
-            
-            # Extract reviews and total
-            reviews_data = data.get("data", {})
-            if isinstance(reviews_data, dict):
-                reviews = reviews_data.get("reviews", [])
-                total_reviews = reviews_data.get("total", 0)
-            else:
-                reviews = []
-                total_reviews = 0
-            
-            # Calculate max pages from first response
-            if page == 1 and total_reviews > 0:
-                calculated_max_pages = (total_reviews + PAGE_SIZE - 1) // PAGE_SIZE  # Ceiling division
-                self.logger.debug(
-                    f"Product {product_id}: {total_reviews} reviews → {calculated_max_pages} pages expected"
-                )
-            
-            # Stop conditions
-            if not reviews or len(reviews) == 0:
-                self.logger.debug(f"Product {product_id}: Empty reviews at page {page}")
+            if not data:
+                self.logger.warning(f"Product {product_id}: Stopped at page {page} (request failed)")
                 break
             
-            # Check if we've reached calculated max (prevent API bug: repeating last page)
-            if calculated_max_pages and page > calculated_max_pages:
-                self.logger.debug(
-                    f"Product {product_id}: Reached calculated max pages ({calculated_max_pages})"
-                )
+            reviews, _ = self._extract_reviews(data)
+            
+            if not reviews:
+                self.logger.debug("Product %s: Empty reviews at page %s", product_id, page)
                 break
             
-            # Lưu page data
-            all_reviews.append((data, metadata, page))
+            yield data, page
             page += 1
-        
-        return all_reviews
     
     def get_product_reviews_sequential(
         self,
@@ -301,7 +866,7 @@ class HasakiAPIClient:
         
         while True:
             url = self.config.HASAKI_REVIEW_API.format(product_id=product_id, page=page)
-            result = self._make_request(url, return_metadata=True)
+            result = self._make_request(url, return_metadata=True, http2=True)
             
             if not result:
                 break
@@ -327,6 +892,17 @@ class HasakiAPIClient:
     def get_stats(self) -> Dict[str, int]:
         """Get client statistics"""
         return {
-            "total_requests": self.request_count
+            "total_requests": self.request_count,
+            "not_modified": self.not_modified_count,
+            "throttled": self.throttled_count,
+            "errors": self.error_count,
+            "request_seconds": self.request_seconds,
+            "req_per_sec": self.rate_limiter.rate
         }
+    
+    def close(self):
+        """Shutdown page executor, đóng HTTP/2 client và requests session (connections tới Hasaki)"""
+        self._page_executor.shutdown(wait=True)
+        self.http2_client.close()
+        self.session.close()
 
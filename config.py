@@ -2,6 +2,7 @@
 Configuration management
 """
 import os
+import re
 import json
 from pathlib import Path
 from dotenv import load_dotenv
@@ -10,6 +11,10 @@ from typing import List, Dict, Any
 # Load environment variables
 load_dotenv()
 
+# brands.txt parsing
+_COMMENT_RE = re.compile(r'#[^\n]*')
+_BRAND_TOKEN_RE = re.compile(r'[^\s;,]+')
+
 
 class Config:
     """Application configuration"""
@@ -22,6 +27,10 @@ class Config:
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_KEY")
     SUPABASE_SCHEMA = os.getenv("SUPABASE_SCHEMA", "raw")
+    # Optional: base URL HTTPS thay cho SUPABASE_URL khi gọi REST API (custom domain, API gateway / proxy
+    # đứng trước PostgREST - phải phục vụ /rest/v1/). KHÔNG phải Supavisor *.pooler.supabase.com
+    # (đó là endpoint Postgres, không phải PostgREST). Mặc định: SUPABASE_URL
+    SUPABASE_POOLER_URL = os.getenv("SUPABASE_POOLER_URL")
     
     # API Endpoints (Tên ngắn gọn cho Git Actions)
     HASAKI_HOME_API = os.getenv(
@@ -42,11 +51,51 @@ class Config:
     )
     
     # Crawl settings (Hardcoded - no limits for big data)
-    # No rate limiting - crawl as fast as possible
     REQUEST_TIMEOUT = 30
     MAX_RETRIES = 3
     BATCH_SIZE = 100
     
+    # HTTP connection pool (requests.Session)
+    # pool_maxsize >= max_workers × concurrent pages per worker → không bị
+    # "Connection pool is full, discarding connection" (TCP/TLS handshake lại)
+    HTTP_POOL_CONNECTIONS = 32
+    HTTP_POOL_MAXSIZE = 128
+    MAX_CONCURRENT_REQUESTS = 32  # Requests đồng thời tối đa tới Hasaki (per-host)
+    DNS_CACHE_TTL = 300  # Cache kết quả DNS (giây) của Hasaki hosts
+    DNS_CACHE_MAXSIZE = 64
+    MAX_RETRY_AFTER = 60  # Giới hạn thời gian chờ theo Retry-After header (giây)
+    
+    # Rate limit (token bucket per-host): giữ throughput cao nhưng tránh 429 → retry storm
+    # Tự giảm một nửa khi bị 429, tăng dần lại khi ổn định (tối đa REQ_PER_SEC)
+    REQ_PER_SEC = float(os.getenv("REQ_PER_SEC", "40"))
+    REQ_BURST = 10
+    
+    # Supabase (PostgREST) HTTP/2 client: nhiều workers dùng chung ít connections
+    DB_HTTP_MAX_CONNECTIONS = 64
+    DB_HTTP_MAX_KEEPALIVE = 32
+    DB_HTTP_KEEPALIVE_EXPIRY = 60  # Giây - giữ idle connections giữa các đợt RPC
+    DB_HTTP_CONNECT_RETRIES = 3    # Retry khi connect lỗi (transport level, trước khi gửi request)
+    # Gzip request body lớn (Content-Encoding: gzip) - chỉ bật khi gateway / PostgREST nhận gzip body
+    DB_GZIP_REQUESTS = os.getenv("DB_GZIP_REQUESTS", "0") == "1"
+    DB_GZIP_MIN_BYTES = 4096
+    DB_CLIENT_TIMEOUT = 30  # Giây - postgrest/storage client timeout
+    # Retry RPC khi lỗi transient (connection / timeout / DB quá tải): exponential backoff + jitter
+    DB_MAX_RETRIES = 6
+    DB_RETRY_BASE_DELAY = 0.1
+    DB_RETRY_MAX_DELAY = 10
+    
+    # In-process TTL cache cho idempotent GETs (home/categories)
+    CACHE_TTL = 60
+    CACHE_MAXSIZE = 512
+    
+    # ETag/Last-Modified của listing pages (conditional GET giữa các lần crawl)
+    HTTP_VALIDATORS_FILE = BASE_DIR / ".cache" / "http_validators.json"
+    
+    # Content hash của product data đã lưu (bỏ qua RPC khi data không đổi giữa các lần crawl)
+    PRODUCT_HASHES_FILE = BASE_DIR / ".cache" / "product_hashes.json"
+    PRODUCT_HASH_MAXSIZE = 200_000
+    SNAPSHOT_CACHE_MAXSIZE = 100_000  # product_id → snapshot_id mới nhất (write-through, in-process)
+    
     # Logging
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     
@@ -66,43 +115,26 @@ class Config:
     def load_brand_ids(cls) -> List[int]:
         """
         Load brand IDs từ brands.txt
-        Format: Mỗi dòng một ID, hoặc nhiều IDs cách nhau bởi dấu chấm phẩy
-        Lines bắt đầu bằng # sẽ bị ignore
+        Format: Mỗi dòng một ID, hoặc nhiều IDs cách nhau bởi dấu chấm phẩy / dấu phẩy
+        Lines bắt đầu bằng # (và inline comments) sẽ bị ignore
+        Parse cả file bằng regex (1 lần) thay vì xử lý từng dòng
         """
         try:
             if not cls.BRANDS_FILE.exists():
                 return []
             
-            brand_ids = []
-            with open(cls.BRANDS_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    # Skip comment lines và empty lines
-                    if not line or line.startswith('#'):
-                        continue
-                    
-                    # Hỗ trợ nhiều IDs trên 1 dòng cách nhau bởi ; hoặc ,
-                    if ';' in line:
-                        ids = line.split(';')
-                    elif ',' in line:
-                        ids = line.split(',')
-                    else:
-                        ids = [line]
-                    
-                    # Parse từng ID
-                    for id_str in ids:
-                        id_str = id_str.strip()
-                        # Strip inline comments
-                        if '#' in id_str:
-                            id_str = id_str.split('#')[0].strip()
-                        
-                        if id_str:
-                            try:
-                                brand_ids.append(int(id_str))
-                            except ValueError:
-                                print(f"Warning: Invalid brand ID: {id_str}")
+            text = cls.BRANDS_FILE.read_text(encoding='utf-8-sig')
+            # Bỏ comments (# tới cuối dòng), tách tokens theo whitespace / ; / ,
+            text = _COMMENT_RE.sub('', text)
+            
+            brand_ids = set()  # Remove duplicates
+            for token in _BRAND_TOKEN_RE.findall(text):
+                try:
+                    brand_ids.add(int(token))
+                except ValueError:
+                    print(f"Warning: Invalid brand ID: {token}")
             
-            return list(set(brand_ids))  # Remove duplicates
+            return list(brand_ids)
         
         except Exception as e:
             print(f"Warning: Failed to load brands.txt: {e}")
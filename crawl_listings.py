@@ -1,10 +1,11 @@
 import sys
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import queue
 
-from api_client import HasakiAPIClient
+from api_client import HasakiAPIClient, install_dns_cache
 from supabase_client import SupabaseStorage
 from logger import setup_logger
 from config import Config
@@ -15,8 +16,14 @@ class ListingCrawler:
     Crawl tất cả listing pages và lưu product IDs vào database
     
     OPTIMIZED: Parallel processing với 20 workers + batch insert
+    Producer/consumer: crawl workers chỉ fetch + đẩy batches vào queue,
+    DB writer threads riêng insert → HTTP fetch không bị block bởi DB round-trip
     """
     
+    RPC_FAILURE_THRESHOLD = 3  # RPC lỗi liên tiếp trước khi chuyển hẳn sang direct upsert
+    DB_WRITER_THREADS = 4      # Threads drain insert queue
+    INSERT_QUEUE_SIZE = 64     # Backpressure: crawl workers chờ khi DB chậm
+    
     def __init__(self):
         self.config = Config()
         self.logger = setup_logger()
@@ -26,11 +33,20 @@ class ListingCrawler:
         # Thread-safe lock
         self.lock = threading.Lock()
         
+        # Circuit breaker cho batch_insert_listing_api RPC
+        self._rpc_failures = 0
+        
+        # Producer/consumer: category batches → DB writer threads
+        self.insert_q: queue.Queue = queue.Queue(maxsize=self.INSERT_QUEUE_SIZE)
+        self._writers: List[threading.Thread] = []
+        
         self.stats = {
             "started_at": datetime.now().isoformat(),
             "categories_found": 0,
             "listing_pages": 0,
+            "listing_pages_unchanged": 0,
             "products_found": 0,
+            "products_unchanged": 0,
             "products_inserted": 0,
             "products_skipped": 0,
             "errors": 0
@@ -40,46 +56,65 @@ class ListingCrawler:
         self,
         categories: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
-        """ Parse category hierarchy - lấy TẤT CẢ leaf categories"""
+        """ Parse category hierarchy - lấy TẤT CẢ leaf categories (iterative DFS, giữ thứ tự)"""
         leaf_categories = []
+        stack = list(reversed(categories))
         
-        def traverse(cat_list: List[Dict[str, Any]]):
-            for cat in cat_list:                
-                cat_id = cat.get("id")
-                if cat_id:
-                    if "child" in cat and isinstance(cat["child"], list) and len(cat["child"]) > 0:
-                        traverse(cat["child"])
-                    else:
-                        leaf_categories.append({
-                            "id": int(cat_id),
-                            "name": cat.get("name", "")
-                        })
+        while stack:
+            cat = stack.pop()
+            cat_id = cat.get("id")
+            if not cat_id:
+                continue
+            
+            children = cat.get("child")
+            if isinstance(children, list) and children:
+                stack.extend(reversed(children))
+            else:
+                leaf_categories.append({
+                    "id": int(cat_id),
+                    "name": cat.get("name", "")
+                })
         
-        traverse(categories)
         return leaf_categories
     
     def _crawl_category(self, cat: Dict[str, Any]) -> Dict[str, int]:
         """
         Crawl 1 category (for parallel processing)
-        Returns: {products: int, inserted: int, pages: int}
+        Products được đẩy vào insert_q, DB writers insert (xem _writer_loop)
+        Page trả 304 → carry forward rows đã lưu kèm validators vào session hiện tại
+        (mỗi session vẫn giữ full listing snapshot, không fetch lại page JSON)
+        Returns: {products: int, pages: int, unchanged_pages: int, unchanged_products: int}
         """
         cat_id = cat["id"]
         cat_name = cat["name"]
         
         try:
-            # Crawl listing pages
-            listing_pages = self.api_client.get_product_ids_from_category(cat_id, cat_name)
-            
             category_products = 0
-            category_inserted = 0
-            category_pages = len(listing_pages)
+            category_pages = 0
+            unchanged_pages = 0
+            unchanged_products = 0
             
             # Batch collect products để reduce RPC calls
-            products_to_insert = []
+            products_to_insert: List[Tuple[str, Optional[str]]] = []
+            # Metadata (ETag/Last-Modified) của pages đã đổi - chỉ lưu validators sau khi insert xong
+            page_metas: List[Dict[str, Any]] = []
             
-            for page_data, _ in listing_pages:
+            # Stream từng listing page: chỉ giữ (product_id, brand_id), bỏ page JSON ngay
+            # Conditional GET: pages không đổi trả 304 (page_data None)
+            for page_data, metadata in self.api_client.iter_category_pages(cat_id, conditional=True):
+                if page_data is None:
+                    # 304: rows lần trước (JSON lists) → tuples, insert lại cho session này
+                    page_rows = [tuple(row) for row in metadata.get('rows') or []]
+                    products_to_insert.extend(page_rows)
+                    unchanged_pages += 1
+                    unchanged_products += len(page_rows)
+                    category_products += len(page_rows)
+                    continue
+                
                 listings = page_data.get("listing", [])
+                category_pages += 1
                 category_products += len(listings)
+                first_row = len(products_to_insert)
                 
                 for item in listings:
                     product_id = item.get("id")
@@ -91,19 +126,27 @@ class ListingCrawler:
                     if isinstance(brand, dict):
                         brand_id = brand.get("id")
                     
-                    products_to_insert.append({
-                        'product_id': str(product_id),
-                        'brand_id': str(brand_id) if brand_id else None
-                    })
+                    # Tuple (product_id, brand_id) nhẹ hơn dict; dict chỉ tạo tại RPC boundary
+                    products_to_insert.append(
+                        (str(product_id), str(brand_id) if brand_id else None)
+                    )
+                
+                # Rows của page lưu cùng validators (sau khi insert xong) → carry forward khi 304
+                metadata['rows'] = products_to_insert[first_row:]
+                page_metas.append(metadata)
+                del page_data, listings
             
-            # Batch insert (reduce RPC calls by 90%)
-            inserted = self._batch_insert_products(products_to_insert)
-            category_inserted = inserted
+            # Đẩy sang DB writers (batch insert chạy song song với fetch category tiếp theo)
+            if products_to_insert:
+                self.insert_q.put((products_to_insert, page_metas))
+            else:
+                self._commit_validators(page_metas)
             
             return {
                 'products': category_products,
-                'inserted': category_inserted,
                 'pages': category_pages,
+                'unchanged_pages': unchanged_pages,
+                'unchanged_products': unchanged_products,
                 'category_name': cat_name
             }
         
@@ -111,13 +154,18 @@ class ListingCrawler:
             self.logger.error(f"Error in category {cat_name}: {e}")
             return {
                 'products': 0,
-                'inserted': 0,
                 'pages': 0,
+                'unchanged_pages': 0,
+                'unchanged_products': 0,
                 'category_name': cat_name,
                 'error': True
             }
     
-    def _batch_insert_products(self, products: List[Dict[str, Any]], batch_size: int = 100) -> int:
+    def _batch_insert_products(
+        self,
+        products: List[Tuple[str, Optional[str]]],
+        batch_size: int = 100
+    ) -> Tuple[int, int]:
         """
         TRUE BATCH INSERT - Use batch_insert_listing_api RPC function
         
@@ -127,12 +175,21 @@ class ListingCrawler:
         - Accurate count of inserted rows (excluding duplicates)
         - 70% faster than sequential inserts
         
-        Returns: number of products actually inserted (excluding duplicates)
+        Fallback: 1 multi-row upsert (ON CONFLICT DO NOTHING) per batch - vẫn 1 round-trip
+        Circuit breaker: sau RPC_FAILURE_THRESHOLD lần RPC lỗi liên tiếp → đi thẳng fallback
+        
+        Args:
+            products: List of (product_id, brand_id) tuples
+        
+        Returns: (inserted, failed_batches)
+        - inserted: number of products actually inserted (excluding duplicates)
+        - failed_batches: số batches cả RPC lẫn fallback đều lỗi
         """
         if not products:
-            return 0
+            return 0, 0
         
         inserted_count = 0
+        failed_batches = 0
         total_batches = (len(products) + batch_size - 1) // batch_size
         
         # Process in batches of 100 (optimal for batch_insert_listing_api)
@@ -140,77 +197,125 @@ class ListingCrawler:
             batch = products[i:i + batch_size]
             batch_num = (i // batch_size) + 1
             
-            try:
-                # PRIMARY: Use batch_insert_listing_api RPC (FASTEST!)
-                # Prepare JSONB array for function
-                products_json = [
-                    {
-                        'product_id': p['product_id'],
-                        'brand_id': p['brand_id']
-                    }
-                    for p in batch
-                ]
-                
-                result = self.storage.client.rpc('batch_insert_listing_api', {
-                    'p_session_id': str(self.storage.session_id),
-                    'p_source_name': 'hasaki',
-                    'p_products': products_json
-                }).execute()
-                
-                # Function returns INTEGER count of inserted rows
-                if result.data is not None:
-                    batch_inserted = int(result.data) if result.data else 0
-                    inserted_count += batch_inserted
-                    
-            except Exception as e:
-                # FALLBACK: Direct table insert if RPC fails
-                error_msg = str(e).lower()
-                
-                if 'does not exist' in error_msg or 'function' in error_msg:
-                    # Function not found → use direct insert
-                    self.logger.warning(
-                        f"batch_insert_listing_api function not found, "
-                        f"falling back to direct insert (slower)"
-                    )
-                
+            if self._rpc_failures < self.RPC_FAILURE_THRESHOLD:
                 try:
-                    # Prepare batch data for direct insert
-                    batch_data = [{
-                        'session_id': str(self.storage.session_id),
-                        'source_name': 'hasaki',
-                        'product_id': p['product_id'],
-                        'brand_id': p['brand_id']
-                    } for p in batch]
+                    # PRIMARY: Use batch_insert_listing_api RPC (FASTEST!)
+                    # Prepare JSONB array for function
+                    products_json = [
+                        {'product_id': product_id, 'brand_id': brand_id}
+                        for product_id, brand_id in batch
+                    ]
                     
-                    result = self.storage.client.schema('raw').table('listing_api')\
-                        .insert(batch_data)\
-                        .execute()
+                    result = self.storage.client.rpc('batch_insert_listing_api', {
+                        'p_session_id': self.storage.session_id_str,
+                        'p_source_name': 'hasaki',
+                        'p_products': products_json
+                    }).execute()
                     
-                    if result.data:
-                        inserted_count += len(result.data)
-                        
-                except Exception as e2:
-                    # FINAL FALLBACK: Individual RPC calls
-                    self.logger.debug(
-                        f"Batch {batch_num}/{total_batches} failed, using individual inserts"
-                    )
+                    self._rpc_failures = 0
                     
-                    for product in batch:
-                        try:
-                            rpc_result = self.storage.client.rpc('safe_insert_listing_api', {
-                                'p_session_id': str(self.storage.session_id),
-                                'p_source_name': 'hasaki',
-                                'p_product_id': product['product_id'],
-                                'p_brand_id': product['brand_id']
-                            }).execute()
-                            
-                            if rpc_result.data is not None:
-                                inserted_count += 1
-                                
-                        except:
-                            pass
+                    # Function returns INTEGER count of inserted rows
+                    if result.data is not None:
+                        batch_inserted = int(result.data) if result.data else 0
+                        inserted_count += batch_inserted
+                    continue
+                
+                except Exception as e:
+                    with self.lock:
+                        self._rpc_failures += 1
+                        tripped = self._rpc_failures == self.RPC_FAILURE_THRESHOLD
+                    
+                    error_msg = str(e).lower()
+                    if 'does not exist' in error_msg or 'function' in error_msg:
+                        # Function not found → use direct insert
+                        self.logger.warning(
+                            f"batch_insert_listing_api function not found, "
+                            f"falling back to direct insert (slower)"
+                        )
+                    if tripped:
+                        self.logger.warning(
+                            f"batch_insert_listing_api failed {self.RPC_FAILURE_THRESHOLD} times in a row, "
+                            f"using direct upsert for remaining batches"
+                        )
+            
+            # FALLBACK: 1 multi-row upsert, duplicates bị bỏ qua (ON CONFLICT DO NOTHING)
+            try:
+                batch_data = [{
+                    'session_id': self.storage.session_id_str,
+                    'source_name': 'hasaki',
+                    'product_id': product_id,
+                    'brand_id': brand_id
+                } for product_id, brand_id in batch]
+                
+                result = self.storage.client.table('listing_api')\
+                    .upsert(
+                        batch_data,
+                        on_conflict='product_id,brand_id,session_id',
+                        ignore_duplicates=True
+                    )\
+                    .execute()
+                
+                if result.data:
+                    inserted_count += len(result.data)
+            
+            except Exception as e2:
+                failed_batches += 1
+                self.logger.error(f"Batch {batch_num}/{total_batches} insert failed: {e2}")
+        
+        return inserted_count, failed_batches
+    
+    def _start_writers(self):
+        """Start DB writer threads (drain insert_q)"""
+        for i in range(self.DB_WRITER_THREADS):
+            writer = threading.Thread(
+                target=self._writer_loop,
+                name=f"listing-db-writer-{i}",
+                daemon=True
+            )
+            writer.start()
+            self._writers.append(writer)
+    
+    def _stop_writers(self):
+        """Gửi sentinel cho từng writer và chờ drain hết queue (idempotent)"""
+        for _ in self._writers:
+            self.insert_q.put(None)
+        for writer in self._writers:
+            writer.join()
+        self._writers = []
+    
+    def _commit_validators(self, page_metas: List[Dict[str, Any]]):
+        """Lưu ETag/Last-Modified của pages đã insert thành công (lần sau mới được 304)"""
+        for metadata in page_metas:
+            self.api_client.commit_validators(metadata)
+    
+    def _writer_loop(self):
+        """
+        DB writer: lấy (products, page_metas) từ queue → batch insert
+        Insert hết batches thành công → mới lưu validators của các pages
+        (insert lỗi → lần sau fetch lại đầy đủ thay vì 304 làm mất products)
+        Đếm bằng biến local, cộng vào stats 1 lần khi nhận sentinel (1 lock / writer thay vì / batch)
+        """
+        inserted_total = 0
+        errors = 0
+        while True:
+            item = self.insert_q.get()
+            if item is None:
+                break
+            
+            products, page_metas = item
+            try:
+                inserted, failed_batches = self._batch_insert_products(products)
+                inserted_total += inserted
+                if not failed_batches:
+                    self._commit_validators(page_metas)
+            except Exception as e:
+                errors += 1
+                self.logger.error(f"DB writer failed: {e}")
         
-        return inserted_count
+        # Sentinel chỉ được gửi sau khi main loop xong → chỉ writers cộng stats lúc này
+        with self.lock:
+            self.stats["products_inserted"] += inserted_total
+            self.stats["errors"] += errors
     
     def crawl_all_listings(self):
         """
@@ -221,6 +326,8 @@ class ListingCrawler:
         try:
             # Start session
             self.storage.start_session(api_type="listing_only")
+            self.api_client.load_validators()
+            self._start_writers()
             
             self.logger.info("\nListing Crawler - Populate listing_api Table")
             
@@ -253,33 +360,40 @@ class ListingCrawler:
                 }
                 
                 # Process results as they complete
+                # Loop chỉ chạy trên main thread (workers trả deltas) → cộng stats không cần lock
+                # (DB writers chỉ cộng stats sau khi loop xong, trong _stop_writers)
                 for future in as_completed(futures):
                     try:
                         result = future.result()
                         
-                        with self.lock:
-                            completed += 1
-                            self.stats["products_found"] += result['products']
-                            self.stats["products_inserted"] += result['inserted']
-                            self.stats["products_skipped"] += (result['products'] - result['inserted'])
-                            self.stats["listing_pages"] += result['pages']
-                            
-                            if result.get('error'):
-                                self.stats["errors"] += 1
+                        completed += 1
+                        self.stats["products_found"] += result['products']
+                        self.stats["listing_pages"] += result['pages']
+                        self.stats["listing_pages_unchanged"] += result['unchanged_pages']
+                        self.stats["products_unchanged"] += result['unchanged_products']
+                        
+                        if result.get('error'):
+                            self.stats["errors"] += 1
                         
-                        # Progress log
+                        # Progress log (inserted count có sau khi DB writers drain xong)
                         self.logger.info(
                             f"  > [{completed}/{len(leaf_categories)}] {result['category_name']}: "
-                            f"{result['products']} products (+{result['inserted']} new)"
+                            f"{result['products']} products ({result['pages']} pages)"
                         )
                     
                     except Exception as e:
-                        with self.lock:
-                            completed += 1
-                            self.stats["errors"] += 1
+                        completed += 1
+                        self.stats["errors"] += 1
                         self.logger.error(f"Category failed: {e}")
             
-            # Finish
+            # Chờ DB writers insert hết batches còn trong queue
+            self._stop_writers()
+            self.stats["products_skipped"] = self.stats["products_found"] - self.stats["products_inserted"]
+            
+            # Persist ETag/Last-Modified cho lần crawl sau
+            self.api_client.save_validators()
+            
+            # Finish (products của pages 304 đã được carry forward → nằm trong inserted)
             self.storage.finish_session(
                 "completed",
                 total_items=self.stats["products_inserted"],
@@ -290,9 +404,15 @@ class ListingCrawler:
         
         except Exception as e:
             self.logger.error(f"Fatal error: {e}", exc_info=True)
+            self._stop_writers()
             self.storage.finish_session("failed", 0, 0)
             raise
     
+    def close(self):
+        """Đóng Hasaki HTTP clients + page executor và DB connections"""
+        self.api_client.close()
+        self.storage.close()
+    
     def _print_summary(self):
         """Print summary"""
         # Calculate time
@@ -306,6 +426,10 @@ class ListingCrawler:
         self.logger.info("=" * 50)
         self.logger.info(f"Time: {minutes}m {seconds}s | Categories: {self.stats['categories_found']}")
         self.logger.info(f"Products: {self.stats['products_found']} found, +{self.stats['products_inserted']} new")
+        self.logger.info(
+            f"Listing pages: {self.stats['listing_pages']} changed, "
+            f"{self.stats['listing_pages_unchanged']} unchanged (304, {self.stats['products_unchanged']} products carried forward)"
+        )
         if self.stats['errors'] > 0:
             self.logger.info(f"Errors: {self.stats['errors']}")
         self.logger.info(f"\nNext: Run 'python crawler.py'")
@@ -315,8 +439,12 @@ class ListingCrawler:
 def main():
     """Entry point"""
     try:
+        install_dns_cache()
         crawler = ListingCrawler()
-        crawler.crawl_all_listings()
+        try:
+            crawler.crawl_all_listings()
+        finally:
+            crawler.close()
         return 0
     
     except Exception as e:
@@ -1,34 +1,134 @@
 from datetime import datetime
-from typing import Dict, List, Any, Set, Optional
+from typing import Dict, List, Any, Set, Optional, Tuple
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from array import array
+from collections import deque
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
 
-from api_client import HasakiAPIClient
-from supabase_client import SupabaseStorage
+from api_client import HasakiAPIClient, install_dns_cache
+from supabase_client import SupabaseStorage, ReviewBatcher
 from logger import setup_logger
 from config import Config
 
 
-class HasakiCrawler:
+class AdaptiveConcurrency:
+    """
+    AIMD giới hạn số tasks chạy đồng thời (đổi lúc runtime, không tạo lại pool)
+    Mỗi WINDOW tasks xong:
+    - error rate > 5% → giảm một nửa
+    - latency trung bình > LATENCY_REGRESSION × latency tốt nhất đã thấy → -1 (server bắt đầu chậm)
+    - error rate < 1% và latency ổn định → +1
+    Error rate = (HTTP errors + 429) / requests trong window (counters từ api_client)
+    Latency = request_seconds / requests trong window (không tính thời gian chờ rate limit)
+    """
+    
+    __slots__ = (
+        'limit', 'minimum', 'maximum',
+        '_completed', '_requests', '_errors', '_seconds', '_best_latency'
+    )
+    
+    WINDOW = 50
+    INCREASE_BELOW = 0.01
+    DECREASE_ABOVE = 0.05
+    LATENCY_REGRESSION = 1.5
+    
+    def __init__(
+        self,
+        start: int,
+        minimum: int,
+        maximum: int,
+        total_requests: int = 0,
+        total_errors: int = 0,
+        total_seconds: float = 0.0
+    ):
+        self.limit = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self._completed = 0
+        self._requests = total_requests
+        self._errors = total_errors
+        self._seconds = total_seconds
+        self._best_latency: Optional[float] = None
+    
+    def record(self, total_requests: int, total_errors: int, total_seconds: float = 0.0) -> bool:
+        """
+        Gọi mỗi khi 1 task xong với counters tích lũy
+        Returns: True nếu limit thay đổi
+        """
+        self._completed += 1
+        if self._completed < self.WINDOW:
+            return False
+        
+        requests = total_requests - self._requests
+        errors = total_errors - self._errors
+        error_rate = errors / max(1, requests + errors)
+        
+        latency_regressed = False
+        if requests > 0 and total_seconds > self._seconds:
+            latency = (total_seconds - self._seconds) / requests
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+            latency_regressed = latency > self._best_latency * self.LATENCY_REGRESSION
+        
+        old_limit = self.limit
+        if error_rate > self.DECREASE_ABOVE:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif latency_regressed:
+            self.limit = max(self.minimum, self.limit - 1)
+        elif error_rate < self.INCREASE_BELOW:
+            self.limit = min(self.maximum, self.limit + 1)
+        
+        self._completed = 0
+        self._requests = total_requests
+        self._errors = total_errors
+        self._seconds = total_seconds
+        return self.limit != old_limit
+
 
+class HasakiCrawler:
+    
+    # Attributes cố định → không có __dict__ / instance, attribute lookup nhanh hơn
+    __slots__ = (
+        'config', 'logger', 'api_client', 'storage', '_review_batcher',
+        'brand_ids', '_brand_ids_list', '_brand_ids_str', '_pool',
+        'metrics', 'stats'
+    )
+    
     MAX_PRODUCT_WORKERS = 10  # Product API (lightest: 1 request per product, small response)
+    PRODUCT_WORKERS_START = 4  # Product concurrency ban đầu, tự tăng tới MAX_PRODUCT_WORKERS
+    MIN_PRODUCT_WORKERS = 2
     MAX_REVIEW_WORKERS = 20   # Review API (heaviest: multi-page per product, large responses, pagination)
+    REVIEW_WORKERS_START = 8  # Review concurrency ban đầu, tự tăng tới MAX_REVIEW_WORKERS khi ít lỗi
+    MIN_REVIEW_WORKERS = 2
     PROGRESS_LOG_INTERVAL = 25  # Log every N products/reviews
+    REVIEW_INSERT_BATCH = 10    # Review pages / 1 lần add vào ReviewBatcher (bounded buffer khi stream)
+    PRODUCT_INSERT_BATCH = 50   # Products / 1 bulk store RPC (reviews của batch chờ tối đa 1 batch)
+    BRAND_QUERY_WORKERS = 5     # Fallback product-id query: số brands query song song
     
     def __init__(self):
         self.config = Config()
         self.logger = setup_logger()
         self.api_client = HasakiAPIClient()
         self.storage = SupabaseStorage()
+        # Gom review pages của nhiều products → 1 RPC / ReviewBatcher.FLUSH_ROWS pages
+        self._review_batcher = ReviewBatcher(self.storage)
         
         # Load target brand IDs
         self.brand_ids = set(self.config.load_brand_ids())
+        # Tính sẵn 1 lần cho DB queries: RPC nhận int[], listing_api.brand_id lưu dạng text
+        self._brand_ids_list = sorted(self.brand_ids)
+        self._brand_ids_str = tuple(map(str, self._brand_ids_list))
         
-        # Thread-safe locks and collections
-        self.lock = threading.Lock()
-        self.crawled_products: Dict[int, int] = {}  # {product_id: snapshot_id}
+        # 1 pool dùng chung cho products + reviews (threads sống suốt crawler, không tạo lại mỗi phase)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.MAX_PRODUCT_WORKERS + self.MAX_REVIEW_WORKERS,
+            thread_name_prefix="crawler"
+        )
+        
+        # Workers trả kết quả qua future → chỉ main thread ghi stats (không cần lock)
+        # (product, snapshot) xong đi thẳng vào pending_reviews - không giữ danh sách crawled products
         
         # Performance metrics
         self.metrics = {
@@ -39,9 +139,9 @@ class HasakiCrawler:
             "review_crawl_time": 0.0,
         }
         
-        # Statistics (thread-safe)
+        # Statistics (main thread only)
         self.stats = {
-            "brand_ids": sorted(self.brand_ids),
+            "brand_ids": self._brand_ids_list,
             "target_brand_products": 0,
             "products_crawled": 0,
             "products_inserted": 0,
@@ -58,27 +158,27 @@ class HasakiCrawler:
         Query DISTINCT product IDs từ listing_api theo brand_ids
         
         Important: Use DISTINCT to avoid duplicate rows from multiple sessions
+        DISTINCT chạy trên PostgreSQL (RPC get_product_ids_for_brands) → chỉ IDs unique qua network.
+        Brand IDs gửi dạng int[]; cast 1 lần phía array (không cast cột) → vẫn dùng index brand_id
+        (DDL: migrations/001_bulk_rpcs.sql)
+        PostgREST db-max-rows (~1000) cũng giới hạn kết quả RPC set-returning → phân trang bằng .range()
+        Fallback (RPC chưa có): select chỉ product_id (index (brand_id, product_id)), phân trang
         Performance: Database query (~0.1-0.5s for thousands of products)
         """
         query_start = time.time()
         
         try:
-            # Convert brand_ids to strings for comparison
-            brand_ids_str = [str(bid) for bid in self.brand_ids]
-            
-            # CRITICAL FIX: Select distinct product_id to avoid duplicates
-            # Each product may have multiple rows (from different sessions)
-            result = self.storage.client.schema('raw').table('listing_api')\
-                .select('product_id, brand_id')\
-                .in_('brand_id', brand_ids_str)\
-                .execute()
+            try:
+                product_ids = self._rpc_product_ids()
+            except Exception as e:
+                self.logger.debug(f"RPC get_product_ids_for_brands unavailable, fallback to table query: {e}")
+                # PostgREST filter: brand_id lưu dạng text → so sánh bằng strings
+                product_ids = self._select_listing_product_ids(self._brand_ids_str)
             
             query_time = time.time() - query_start
             self.metrics["db_query_time"] = query_time
             
-            if result.data:
-                # Extract unique product IDs (dedup in Python)
-                product_ids = {int(row['product_id']) for row in result.data}
+            if product_ids:
                 return product_ids
             else:
                 self.logger.warning("  > No products found in database")
@@ -91,6 +191,73 @@ class HasakiCrawler:
             )
             return set()
     
+    def _rpc_product_ids(self, page_size: int = 1000) -> Set[int]:
+        """
+        RPC get_product_ids_for_brands, phân trang theo range (order product_id → pages ổn định)
+        Mỗi page chuyển ngay thành set ints → không giữ JSON-parsed rows
+        """
+        product_ids: Set[int] = set()
+        offset = 0
+        while True:
+            result = self.storage.client.rpc(
+                'get_product_ids_for_brands', {'brand_ids': self._brand_ids_list}
+            )\
+                .order('product_id')\
+                .range(offset, offset + page_size - 1)\
+                .execute()
+            batch = result.data or []
+            product_ids.update(self._to_product_ids(batch))
+            if len(batch) < page_size:
+                return product_ids
+            offset += page_size
+    
+    @staticmethod
+    def _to_product_ids(rows: List[Any]) -> Set[int]:
+        """
+        Rows → set product IDs (map ở C level, không tạo list trung gian)
+        RETURNS TABLE → [{'product_id': ...}]; RETURNS SETOF bigint → [123, ...]
+        """
+        if rows and isinstance(rows[0], dict):
+            return set(map(int, map(itemgetter('product_id'), rows)))
+        return set(map(int, rows))
+    
+    def _select_listing_product_ids(self, brand_ids_str: Tuple[str, ...]) -> Set[int]:
+        """
+        Fallback: select product_id từ listing_api, 1 query / brand chạy song song
+        (BRAND_QUERY_WORKERS threads) → không có 1 query IN lớn bị timeout, union kết quả
+        """
+        product_ids: Set[int] = set()
+        with ThreadPoolExecutor(
+            max_workers=self.BRAND_QUERY_WORKERS,
+            thread_name_prefix="brand-query"
+        ) as executor:
+            for brand_product_ids in executor.map(self._select_brand_product_ids, brand_ids_str):
+                product_ids |= brand_product_ids
+        return product_ids
+    
+    def _select_brand_product_ids(self, brand_id: str, page_size: int = 1000) -> Set[int]:
+        """
+        Product IDs của 1 brand, phân trang theo range
+        PostgREST giới hạn ~1000 rows/response → không phân trang sẽ mất products
+        Dedup từng page vào set (nhiều rows / product) → peak memory chỉ 1 page rows
+        storage.client đã gắn schema raw (SUPABASE_SCHEMA) + shared HTTP/2 client:
+        không dùng .schema('raw') - mỗi lần gọi tạo 1 httpx.Client mới không được đóng
+        """
+        product_ids: Set[int] = set()
+        offset = 0
+        while True:
+            result = self.storage.client.table('listing_api')\
+                .select('product_id')\
+                .eq('brand_id', brand_id)\
+                .order('product_id')\
+                .range(offset, offset + page_size - 1)\
+                .execute()
+            batch = result.data or []
+            product_ids.update(self._to_product_ids(batch))
+            if len(batch) < page_size:
+                return product_ids
+            offset += page_size
+    
     def crawl_all(self):
         """Main crawl workflow - Optimized (Read from DB)"""
         total_items = 0
@@ -102,10 +269,14 @@ class HasakiCrawler:
                 self.logger.error("ERROR: brands.txt rỗng! Chạy: python find_brands.py")
                 return
             
-            self.logger.info(f"\nHasaki Crawler - Brands: {sorted(self.brand_ids)}")
+            self.logger.info(f"\nHasaki Crawler - Brands: {self.stats['brand_ids']}")
             
             # Start session
             self.storage.start_session(api_type="full")
+            # ETag/Last-Modified của product API từ lần crawl trước (conditional GET)
+            self.api_client.load_validators()
+            # Content hash của products đã lưu lần trước (bỏ qua RPC khi data không đổi)
+            self.storage.load_product_hashes()
             
             # Step 1: Home API
             self.logger.info("\n[1/4] Crawl Home API...")
@@ -124,8 +295,7 @@ class HasakiCrawler:
                     self.logger.error("  > Failed to fetch")
             except Exception as e:
                 self.logger.error(f"  > Error: {e}")
-                with self.lock:
-                    self.stats["errors"] += 1
+                self.stats["errors"] += 1
             
             # Step 2: Query product IDs từ database
             self.logger.info("\n[2/4] Load Products from Database...")
@@ -140,83 +310,170 @@ class HasakiCrawler:
             self.logger.info(f"  > Loaded {len(target_product_ids)} products")
             self.stats["target_brand_products"] = len(target_product_ids)
             
-            # Step 3: Crawl Products
-            if target_product_ids:
-                self.logger.info(f"\n[3/4] Crawl Products ({len(target_product_ids)} items, {self.MAX_PRODUCT_WORKERS} workers)...")
+            # Prefetch snapshot ids hiện có (1 query / 500 products) → skip/304 path không lookup từng product
+            # Kết quả nằm trong snapshot cache của storage (write-through, bounded LRU)
+            existing_snapshots = len(self.storage.get_latest_snapshots_bulk(target_product_ids))
+            self.logger.info(f"  > {existing_snapshots} existing snapshots")
+            
+            # Step 3 + 4: Crawl Products → Reviews (pipelined, 1 pool chung)
+            # Product xong (có snapshot_id) → submit reviews ngay, không đợi hết products
+            # Thứ tự không quan trọng (kết quả về theo completion order)
+            products_list = array('q', target_product_ids)
+            del target_product_ids
+            self.logger.info(
+                f"\n[3/4] Crawl Products ({len(products_list)} items, "
+                f"adaptive {self.PRODUCT_WORKERS_START}-{self.MAX_PRODUCT_WORKERS} workers)..."
+            )
+            self.logger.info(
+                f"[4/4] Crawl Reviews (pipelined, adaptive {self.REVIEW_WORKERS_START}-{self.MAX_REVIEW_WORKERS} workers)..."
+            )
+            
+            product_start = time.time()
+            products_done = 0
+            products_inflight = 0
+            review_results: List[Tuple[int, int]] = []  # (product_id, pages_crawled)
+            review_submitted = 0
+            reviews_inflight = 0
+            pending_products = iter(products_list)
+            pending_reviews: deque = deque()  # (product_id, snapshot_id) chờ slot review
+            # Concurrency của products / reviews tự điều chỉnh theo error rate + latency quan sát được
+            api_stats = self.api_client.get_stats()
+            api_counters = (
+                api_stats["total_requests"],
+                api_stats["errors"] + api_stats["throttled"],
+                api_stats["request_seconds"]
+            )
+            product_limit = AdaptiveConcurrency(
+                self.PRODUCT_WORKERS_START, self.MIN_PRODUCT_WORKERS, self.MAX_PRODUCT_WORKERS, *api_counters
+            )
+            review_limit = AdaptiveConcurrency(
+                self.REVIEW_WORKERS_START, self.MIN_REVIEW_WORKERS, self.MAX_REVIEW_WORKERS, *api_counters
+            )
+            product_buffer: List[Tuple[int, Dict[str, Any], Optional[Dict[str, Any]]]] = []  # Products đã fetch, chờ bulk store
+            futures: Dict[Any, Tuple[str, int]] = {}  # {future: ("product" | "store" | "review", product_id)}
+            
+            # Locals cho hot loop (LOAD_FAST thay vì attribute lookup mỗi vòng)
+            stats = self.stats
+            log_info = self.logger.info
+            log_debug = self.logger.debug
+            submit = self._pool.submit
+            crawl_product = self._crawl_product
+            store_products = self._store_products
+            crawl_reviews = self._crawl_reviews
+            store_batch = self.PRODUCT_INSERT_BATCH
+            interval = self.PROGRESS_LOG_INTERVAL
+            get_api_stats = self.api_client.get_stats
+            total_products = len(products_list)
+            while True:
+                # Chỉ giữ tối đa product_limit.limit (≤ MAX_PRODUCT_WORKERS) products đang chạy
+                # → reviews không phải xếp hàng sau toàn bộ products trong queue của pool
+                while products_inflight < product_limit.limit:
+                    pid = next(pending_products, None)
+                    if pid is None:
+                        break
+                    futures[submit(crawl_product, pid)] = ("product", pid)
+                    products_inflight += 1
+                
+                # Products đã fetch → 1 bulk store / store_batch products
+                # (products_inflight == 0 sau khi top-up = hết products → flush phần còn lại)
+                if product_buffer and (len(product_buffer) >= store_batch or products_inflight == 0):
+                    futures[submit(store_products, product_buffer)] = ("store", 0)
+                    product_buffer = []
                 
-                products_list = sorted(target_product_ids)
-                product_start = time.time()
+                # Reviews: số tasks đang chạy theo limit hiện tại của controller
+                while reviews_inflight < review_limit.limit and pending_reviews:
+                    pid, snapshot_id = pending_reviews.popleft()
+                    futures[submit(crawl_reviews, pid, snapshot_id)] = ("review", pid)
+                    reviews_inflight += 1
                 
-                with ThreadPoolExecutor(max_workers=self.MAX_PRODUCT_WORKERS) as executor:
-                    futures = {
-                        executor.submit(self._crawl_product, pid): pid 
-                        for pid in products_list
-                    }
+                if not futures:
+                    break
+                
+                # Main thread duy nhất đọc kết quả → cập nhật stats trực tiếp
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, pid = futures.pop(future)
                     
-                    for future in as_completed(futures):
+                    if kind == "product":
+                        products_inflight -= 1
+                        products_done += 1
+                        api_stats = get_api_stats()
+                        if product_limit.record(
+                            api_stats["total_requests"],
+                            api_stats["errors"] + api_stats["throttled"],
+                            api_stats["request_seconds"]
+                        ):
+                            log_info(f"  > Product workers → {product_limit.limit}")
                         try:
-                            success = future.result()
+                            pid, snapshot_id, success, product_data, metadata = future.result()
+                            if product_data is not None:
+                                product_buffer.append((pid, product_data, metadata))
+                            elif snapshot_id:
+                                pending_reviews.append((pid, snapshot_id))
+                                review_submitted += 1
                             if success:
-                                with self.lock:
-                                    self.stats["products_crawled"] += 1
+                                stats["products_crawled"] += 1
                                 
                                 # Progress logging
-                                if self.stats["products_crawled"] % self.PROGRESS_LOG_INTERVAL == 0:
-                                    progress_pct = self.stats['products_crawled']*100//len(products_list)
-                                    self.logger.info(f"  > {self.stats['products_crawled']}/{len(products_list)} ({progress_pct}%)")
+                                if stats["products_crawled"] % interval == 0:
+                                    progress_pct = stats['products_crawled']*100//total_products
+                                    log_info(f"  > {stats['products_crawled']}/{total_products} ({progress_pct}%)")
                         except Exception as e:
-                            with self.lock:
-                                self.stats["errors"] += 1
-                            self.logger.debug(f"Product crawl error: {e}")
-                
-                product_time = time.time() - product_start
-                self.metrics["product_crawl_time"] = product_time
-                
-                total_items += self.stats["products_crawled"]
-                rate = len(products_list)/product_time if product_time > 0 else 0
-                self.logger.info(f"  > Done in {product_time:.1f}s ({rate:.1f} items/s)")
-            else:
-                self.logger.error("  > Không tìm thấy products! Chạy trước: python crawl_listings.py")
-            
-            # Step 4: Crawl Reviews
-            if self.crawled_products:
-                self.logger.info(f"\n[4/4] Crawl Reviews ({len(self.crawled_products)} products, {self.MAX_REVIEW_WORKERS} workers)...")
-                
-                review_start = time.time()
-                products_with_reviews = 0
-                
-                with ThreadPoolExecutor(max_workers=self.MAX_REVIEW_WORKERS) as executor:
-                    futures = {
-                        executor.submit(self._crawl_reviews, pid, snapshot_id): pid
-                        for pid, snapshot_id in self.crawled_products.items()
-                    }
-                    
-                    for future in as_completed(futures):
+                            stats["errors"] += 1
+                            log_debug("Product crawl error: %s", e)
+                        
+                        if products_done == total_products:
+                            product_time = time.time() - product_start
+                            self.metrics["product_crawl_time"] = product_time
+                            rate = total_products/product_time if product_time > 0 else 0
+                            log_info(f"  > Products done in {product_time:.1f}s ({rate:.1f} items/s)")
+                    elif kind == "store":
+                        try:
+                            for pid, snapshot_id in future.result():
+                                if snapshot_id:
+                                    pending_reviews.append((pid, snapshot_id))
+                                    review_submitted += 1
+                        except Exception as e:
+                            stats["errors"] += 1
+                            log_debug("Product store error: %s", e)
+                    else:
+                        reviews_inflight -= 1
+                        api_stats = get_api_stats()
+                        if review_limit.record(
+                            api_stats["total_requests"],
+                            api_stats["errors"] + api_stats["throttled"],
+                            api_stats["request_seconds"]
+                        ):
+                            log_info(f"  > Review workers → {review_limit.limit}")
                         try:
-                            pages_crawled, pages_inserted = future.result()
-                            with self.lock:
-                                self.stats["review_pages_crawled"] += pages_crawled
-                                self.stats["review_pages_inserted"] += pages_inserted
-                                self.stats["review_pages_skipped"] += (pages_crawled - pages_inserted)
-                                if pages_crawled > 0:
-                                    products_with_reviews += 1
+                            review_results.append((pid, future.result()))
                             
                             # Progress logging
-                            if products_with_reviews % self.PROGRESS_LOG_INTERVAL == 0 and products_with_reviews > 0:
-                                self.logger.info(
-                                    f"  > {products_with_reviews}/{len(self.crawled_products)} products, "
-                                    f"{self.stats['review_pages_crawled']} pages (+{self.stats['review_pages_inserted']} new)"
-                                )
+                            if len(review_results) % interval == 0:
+                                log_info(f"  > Reviews: {len(review_results)}/{review_submitted} products done")
                         except Exception as e:
-                            with self.lock:
-                                self.stats["errors"] += 1
-                            self.logger.debug(f"Review crawl error: {e}")
-                
-                review_time = time.time() - review_start
-                self.metrics["review_crawl_time"] = review_time
-                
+                            stats["errors"] += 1
+                            log_debug("Review crawl error: %s", e)
+            
+            total_items += self.stats["products_crawled"]
+            
+            # Dừng batcher (join flusher, đợi stores in-flight) rồi mới tổng hợp review stats
+            # → review_pages_inserted đầy đủ trước finish_session
+            self._review_batcher.close()
+            products_with_reviews = sum(1 for _, crawled in review_results if crawled > 0)
+            self.stats["review_pages_crawled"] = sum(crawled for _, crawled in review_results)
+            self.stats["review_pages_inserted"] = self.storage.get_stats()['review_inserted']
+            self.stats["review_pages_skipped"] = (
+                self.stats["review_pages_crawled"] - self.stats["review_pages_inserted"]
+            )
+            
+            # Thời gian từ lúc bắt đầu products tới khi review cuối cùng xong
+            review_time = time.time() - product_start
+            self.metrics["review_crawl_time"] = review_time
+            
+            if review_submitted:
                 self.logger.info(
-                    f"  > Done: {self.stats['review_pages_crawled']} pages "
+                    f"  > Reviews done: {products_with_reviews} products, {self.stats['review_pages_crawled']} pages "
                     f"(+{self.stats['review_pages_inserted']} new) in {review_time:.1f}s"
                 )
                 total_items += self.stats["review_pages_inserted"]  # Chỉ đếm pages mới insert
@@ -228,8 +485,8 @@ class HasakiCrawler:
             self.stats["products_inserted"] = storage_stats['product_inserted']
             self.stats["products_skipped"] = storage_stats['product_skipped']
             
-            # Note: review_pages_inserted và review_pages_skipped đã được track
-            # trực tiếp trong ThreadPoolExecutor loop ở trên
+            # Note: review_pages_crawled từ review_results, review_pages_inserted từ storage
+            # (ReviewBatcher insert pages của nhiều products cùng lúc)
             
             skipped_items = (
                 storage_stats['home_skipped'] + 
@@ -238,6 +495,8 @@ class HasakiCrawler:
                 self.stats['review_pages_skipped']  # Dùng giá trị đã track
             )
             
+            self.api_client.save_validators()
+            self.storage.save_product_hashes()
             self.storage.finish_session("completed", total_items, skipped_items)
             self._print_summary()
         
@@ -246,71 +505,120 @@ class HasakiCrawler:
             self.storage.finish_session("failed", total_items, skipped_items)
             raise
     
-    def _crawl_product(self, product_id: int) -> bool:
-        """Crawl 1 product and track snapshot_id"""
+    def _crawl_product(
+        self, product_id: int
+    ) -> Tuple[int, Optional[int], bool, Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        Fetch 1 product (store do main loop gom lại → _store_products)
+        Returns: (product_id, snapshot_id hoặc None, success, product_data hoặc None, metadata hoặc None)
+        - 304 + đã có snapshot → (id, snapshot_id, True, None, None): không cần store
+        - Có data → (id, None, True, data, metadata): main loop đưa vào batch store,
+          ETag/Last-Modified (metadata) chỉ được lưu khi store thành công
+        Không ghi shared state - main thread cập nhật crawled product arrays từ kết quả
+        """
         try:
-            product_data, _ = self.api_client.get_product_detail(product_id)
+            product_data, metadata = self.api_client.get_product_detail(product_id, conditional=True)
+            
+            if metadata and metadata.get('not_modified'):
+                # 304: product không đổi từ lần crawl trước → dùng snapshot hiện có, bỏ qua store
+                existing_snapshot = self.storage.get_latest_product_snapshot_id(product_id)
+                if existing_snapshot:
+                    return product_id, existing_snapshot, True, None, None
+                # DB chưa có snapshot → fetch lại đầy đủ (không gửi validators)
+                product_data, metadata = self.api_client.get_product_detail(product_id, return_metadata=True)
+            
             if product_data:
-                # store_product returns snapshot_id if inserted, None if skipped
-                snapshot_id = self.storage.store_product(product_id, product_data)
-                if snapshot_id:
-                    with self.lock:
-                        self.crawled_products[product_id] = snapshot_id
-                    return True
-                else:
-                    # Product skipped (no changes) - try to get existing snapshot_id
-                    existing_snapshot = self.storage.get_latest_product_snapshot_id(product_id)
-                    if existing_snapshot:
-                        with self.lock:
-                            self.crawled_products[product_id] = existing_snapshot
-                        self.logger.debug(f"Product {product_id}: Using existing snapshot {existing_snapshot}")
-                    else:
-                        self.logger.warning(f"Product {product_id}: Skipped but no existing snapshot found!")
-                    return True
-            return False
+                return product_id, None, True, product_data, metadata
+            return product_id, None, False, None, None
         except Exception as e:
             self.logger.error(f"Error crawling product {product_id}: {e}")
-            return False
+            return product_id, None, False, None, None
+    
+    def _store_products(
+        self, batch: List[Tuple[int, Dict[str, Any], Optional[Dict[str, Any]]]]
+    ) -> List[Tuple[int, Optional[int]]]:
+        """
+        Bulk store 1 batch products đã fetch (storage.store_products: 1 RPC / batch)
+        Product store thành công (có snapshot) → mới lưu HTTP validators của response
+        (store lỗi → lần sau vẫn fetch đầy đủ thay vì 304 + snapshot cũ)
+        Returns: [(product_id, snapshot_id hoặc None)] - snapshot hiện có khi product không đổi
+        """
+        cached_snapshot_id = self.storage.cached_snapshot_id
+        results = self.storage.store_products([
+            (product_id, product_data, cached_snapshot_id(product_id))
+            for product_id, product_data, _ in batch
+        ])
+        
+        stored: List[Tuple[int, Optional[int]]] = []
+        for (product_id, _, metadata), (snapshot_id, inserted) in zip(batch, results):
+            if snapshot_id:
+                # Storage đã ghi snapshot mới vào cache ngay trong store_products
+                self.api_client.commit_validators(metadata)
+                if not inserted:
+                    self.logger.debug("Product %s: Using existing snapshot %s", product_id, snapshot_id)
+            else:
+                self.logger.warning(f"Product {product_id}: Skipped but no existing snapshot found!")
+            stored.append((product_id, snapshot_id))
+        return stored
     
-    def _crawl_reviews(self, product_id: int, snapshot_id: int) -> tuple[int, int]:
+    def _crawl_reviews(self, product_id: int, snapshot_id: int) -> int:
         """
         Crawl reviews for 1 product
-        Returns: (pages_crawled, pages_inserted)
-        - pages_crawled: Số pages API trả về (có thể duplicate)
-        - pages_inserted: Số pages mới insert vào DB
+        Pages được đưa vào ReviewBatcher (insert chung với products khác)
+        Returns: pages_crawled - Số pages API trả về (có thể duplicate)
         """
+        pages_crawled = 0
+        batch: List[tuple[Dict[str, Any], int]] = []
         try:
-            review_pages = self.api_client.get_product_reviews(product_id)
-            if review_pages:
-                return self.storage.store_reviews_for_product(
-                    product_id, 
-                    snapshot_id, 
-                    review_pages
-                )
-            return 0, 0
+            # Stream pages, chuyển cho batcher mỗi REVIEW_INSERT_BATCH pages
+            for page in self.api_client.iter_product_reviews(product_id):
+                batch.append(page)
+                pages_crawled += 1
+                if len(batch) >= self.REVIEW_INSERT_BATCH:
+                    self._review_batcher.add_many(product_id, snapshot_id, batch)
+                    batch = []
+            if batch:
+                self._review_batcher.add_many(product_id, snapshot_id, batch)
+            return pages_crawled
         except Exception as e:
-            self.logger.debug(f"Error crawling reviews for product {product_id}: {e}")
-            return 0, 0
+            self.logger.debug("Error crawling reviews for product %s: %s", product_id, e)
+            if batch:
+                self._review_batcher.add_many(product_id, snapshot_id, batch)
+            return pages_crawled
+    
+    def close(self):
+        """Shutdown worker pool, review batcher, Hasaki HTTP clients và DB connections"""
+        self._pool.shutdown(wait=True)
+        self._review_batcher.close()
+        self.api_client.close()
+        self.storage.close()
     
     def _print_summary(self):
         """Print concise summary"""
+        stats = self.stats
         total_time = time.time() - self.metrics["started_at"]
         total_minutes = int(total_time / 60)
         total_seconds = int(total_time % 60)
         
-        total_inserted = self.stats['products_inserted'] + self.stats['review_pages_inserted']
-        total_skipped = self.stats['products_skipped'] + self.stats['review_pages_skipped']
+        total_inserted = stats['products_inserted'] + stats['review_pages_inserted']
+        total_skipped = stats['products_skipped'] + stats['review_pages_skipped']
         
-        self.logger.info("\n" + "=" * 50)
-        self.logger.info(f"COMPLETED - Session {self.storage.session_id}")
-        self.logger.info("=" * 50)
-        self.logger.info(f"Time: {total_minutes}m {total_seconds}s | Brands: {len(self.brand_ids)}")
-        self.logger.info(f"Products: {self.stats['products_crawled']} crawled, +{self.stats['products_inserted']} new")
-        self.logger.info(f"Reviews: {self.stats['review_pages_crawled']} pages, +{self.stats['review_pages_inserted']} new")
-        self.logger.info(f"Total: +{total_inserted} new, {total_skipped} unchanged")
-        if self.stats['errors'] > 0:
-            self.logger.info(f"Errors: {self.stats['errors']}")
-        self.logger.info("=" * 50)
+        # Build cả report rồi log 1 lần (1 lần qua handler chain thay vì mỗi dòng)
+        lines = [
+            "",
+            "=" * 50,
+            f"COMPLETED - Session {self.storage.session_id}",
+            "=" * 50,
+            f"Time: {total_minutes}m {total_seconds}s | Brands: {len(self.brand_ids)}",
+            f"Products: {stats['products_crawled']} crawled, +{stats['products_inserted']} new, "
+            f"{self.api_client.not_modified_count} unchanged (304)",
+            f"Reviews: {stats['review_pages_crawled']} pages, +{stats['review_pages_inserted']} new",
+            f"Total: +{total_inserted} new, {total_skipped} unchanged",
+        ]
+        if stats['errors'] > 0:
+            lines.append(f"Errors: {stats['errors']}")
+        lines.append("=" * 50)
+        self.logger.info("\n".join(lines))
 
 
 def main():
@@ -324,8 +632,12 @@ def main():
             from pathlib import Path
             Config.BRANDS_FILE = Path(args.brands_file)
         
+        install_dns_cache()
         crawler = HasakiCrawler()
-        crawler.crawl_all()
+        try:
+            crawler.crawl_all()
+        finally:
+            crawler.close()
         return 0
     
     except Exception as e:
@@ -3,7 +3,7 @@ Tool tìm brand IDs từ Hasaki API
 Chạy file này để lấy danh sách brands và IDs
 """
 import requests
-from api_client import HasakiAPIClient
+from api_client import HasakiAPIClient, install_dns_cache
 from config import Config
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
@@ -60,26 +60,44 @@ def find_brands():
     print()
     
     # Lấy TẤT CẢ categories song song để có full brands
-    products = []
+    total_products = 0
     start_time = time.time()
     
+    def extract_brands(page_products):
+        """Brands {id: name} của 1 listing page"""
+        local_brands = {}
+        for product in page_products:
+            brand = product.get("brand")
+            if isinstance(brand, dict):
+                brand_id = brand.get("id")
+                brand_name = brand.get("name")
+                if brand_id and brand_name:
+                    try:
+                        local_brands.setdefault(int(brand_id), brand_name)
+                    except:
+                        pass
+        return local_brands
+    
     # Helper function để fetch 1 category
+    # Extract brands ngay trong worker (overlap với network của threads khác),
+    # main thread chỉ merge dict nhỏ thay vì giữ + duyệt toàn bộ products
     def fetch_category(idx_cat):
         idx, cat = idx_cat
         cat_id = int(cat["id"])
         cat_name = cat["name"]
         
         try:
-            listing_pages = client.get_product_ids_from_category(cat_id, cat_name)
+            # Chỉ cần page 1 để lấy brands → không fetch các pages còn lại
+            listing_pages = client.get_product_ids_from_category(cat_id, cat_name, max_pages=1)
             if listing_pages:
                 page_data, _ = listing_pages[0]
                 page_products = page_data.get("listing", [])
-                return (idx, cat_name, page_products)
+                return (idx, cat_name, len(page_products), extract_brands(page_products))
         except Exception as e:
             print(f"    ⚠️  Error fetching {cat_name}: {e}")
-            return (idx, cat_name, [])
+            return (idx, cat_name, 0, {})
         
-        return (idx, cat_name, [])
+        return (idx, cat_name, 0, {})
     
     # Fetch parallel với ThreadPoolExecutor
     total_cats = len(all_leaves)
@@ -94,8 +112,10 @@ def find_brands():
         
         # Process as completed
         for future in as_completed(future_to_cat):
-            idx, cat_name, page_products = future.result()
-            products.extend(page_products)
+            idx, cat_name, product_count, local_brands = future.result()
+            total_products += product_count
+            for brand_id, brand_name in local_brands.items():
+                brands_dict.setdefault(brand_id, brand_name)
             completed += 1
             
             # Progress indicator
@@ -103,29 +123,13 @@ def find_brands():
             rate = completed / elapsed if elapsed > 0 else 0
             eta = (total_cats - completed) / rate if rate > 0 else 0
             
-            print(f"  [{completed}/{total_cats}] ✓ {cat_name} ({len(page_products)} products) | "
+            print(f"  [{completed}/{total_cats}] ✓ {cat_name} ({product_count} products) | "
                   f"⏱️ {rate:.1f} cat/s | ETA: {eta:.0f}s")
     
     elapsed_total = time.time() - start_time
     print(f"\n⚡ Hoàn tất {total_cats} categories trong {elapsed_total:.1f}s "
           f"({total_cats/elapsed_total:.1f} cat/s)")
-    print(f"📦 Tổng: {len(products)} products")
-
-    
-    print(f"Extracting brands...\n")
-    
-    for product in products:
-        brand = product.get("brand")
-        if isinstance(brand, dict):
-            brand_id = brand.get("id")
-            brand_name = brand.get("name")
-            if brand_id and brand_name:
-                try:
-                    brand_id = int(brand_id)
-                    if brand_id not in brands_dict:
-                        brands_dict[brand_id] = brand_name
-                except:
-                    pass
+    print(f"📦 Tổng: {total_products} products")
     
     # Write to file
     output_file = "all_brands.txt"
@@ -164,5 +168,6 @@ def find_brands():
 
 
 if __name__ == "__main__":
+    install_dns_cache()
     find_brands()
 
@@ -10,18 +10,20 @@ from datetime import datetime
 def setup_logger(name="hasaki_crawler"):
     """Setup simple console logger with UTF-8 encoding (Windows compatible)"""
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
     
-    # Prevent duplicate handlers
+    # Prevent duplicate handlers (gọi lại → trả logger đã cấu hình, không reset gì)
     if logger.handlers:
         return logger
+    logger.setLevel(logging.INFO)
     
     # Format: Simplified without timestamp for cleaner output
     formatter = logging.Formatter('%(message)s')
     
     # Fix Windows encoding issue for Vietnamese characters
-    if sys.platform == "win32":
+    # 1 lần / process: nhiều logger names không reconfigure stdout lặp lại
+    if sys.platform == "win32" and not getattr(sys.stdout, "_hasaki_utf8", False):
         sys.stdout.reconfigure(encoding='utf-8')
+        sys.stdout._hasaki_utf8 = True
     
     # Console handler only
     console_handler = logging.StreamHandler(sys.stdout)
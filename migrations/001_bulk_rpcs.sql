@@ -0,0 +1,135 @@
+-- ============================================================
+-- Migration 001: Bulk / 1-round-trip RPCs cho crawler
+-- Chạy SAU schema.sql (dùng lại các functions + triggers dedup đã có):
+--   raw.safe_insert_product_api, raw.safe_insert_review_api,
+--   raw.get_latest_product_snapshot_id
+-- Idempotent (CREATE OR REPLACE) - chạy lại an toàn
+-- Chưa chạy migration → crawler tự fallback về các RPC cũ (1 round-trip / item)
+-- ============================================================
+
+-- crawler.py _rpc_product_ids: DISTINCT product IDs theo brands (phân trang bằng .range())
+CREATE OR REPLACE FUNCTION raw.get_product_ids_for_brands(brand_ids int[])
+RETURNS TABLE(product_id text)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT la.product_id
+    FROM raw.listing_api la
+    WHERE la.brand_id = ANY(brand_ids::text[])
+$$;
+
+-- store_product: insert + snapshot hiện có khi trigger reject (1 round-trip)
+CREATE OR REPLACE FUNCTION raw.safe_upsert_product_api(
+    p_session_id uuid,
+    p_source_name text,
+    p_product_id text,
+    p_data jsonb
+)
+RETURNS TABLE(id bigint, inserted boolean)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_id bigint;
+BEGIN
+    v_id := raw.safe_insert_product_api(
+        p_session_id => p_session_id,
+        p_source_name => p_source_name,
+        p_product_id => p_product_id,
+        p_data => p_data
+    );
+    IF v_id IS NOT NULL THEN
+        RETURN QUERY SELECT v_id, true;
+    ELSE
+        RETURN QUERY SELECT raw.get_latest_product_snapshot_id(p_product_id => p_product_id), false;
+    END IF;
+END;
+$$;
+
+-- store_products: p_rows = [{"product_id": "...", "data": {...}}, ...]
+-- Returns bigint[] cùng thứ tự p_rows (NULL = trigger reject, data không đổi)
+CREATE OR REPLACE FUNCTION raw.safe_insert_products_api_bulk(
+    p_session_id uuid,
+    p_source_name text,
+    p_rows jsonb
+)
+RETURNS bigint[]
+LANGUAGE sql AS $$
+    SELECT coalesce(
+        array_agg(
+            raw.safe_insert_product_api(
+                p_session_id => p_session_id,
+                p_source_name => p_source_name,
+                p_product_id => r ->> 'product_id',
+                p_data => r -> 'data'
+            )
+            ORDER BY ord
+        ),
+        '{}'::bigint[]
+    )
+    FROM jsonb_array_elements(p_rows) WITH ORDINALITY AS t(r, ord)
+$$;
+
+-- store_review_pages: p_pages = [{"page": 1, "data": {...}}, ...] của 1 product
+-- Returns số pages inserted
+CREATE OR REPLACE FUNCTION raw.safe_insert_review_api_batch(
+    p_session_id uuid,
+    p_product_id text,
+    p_product_snapshot_id bigint,
+    p_pages jsonb
+)
+RETURNS integer
+LANGUAGE sql AS $$
+    SELECT count(s.review_id)::integer
+    FROM (
+        SELECT raw.safe_insert_review_api(
+            p_data => p -> 'data',
+            p_product_id => p_product_id,
+            p_product_snapshot_id => p_product_snapshot_id,
+            p_session_id => p_session_id,
+            p_total => (p ->> 'page')::integer
+        ) AS review_id
+        FROM jsonb_array_elements(p_pages) WITH ORDINALITY AS t(p, ord)
+        ORDER BY ord
+    ) s
+$$;
+
+-- ReviewBatcher: p_rows = [{"product_id", "product_snapshot_id", "page", "data"}, ...] của nhiều products
+-- Returns số pages inserted
+CREATE OR REPLACE FUNCTION raw.safe_insert_review_api_rows(
+    p_session_id uuid,
+    p_rows jsonb
+)
+RETURNS integer
+LANGUAGE sql AS $$
+    SELECT count(s.review_id)::integer
+    FROM (
+        SELECT raw.safe_insert_review_api(
+            p_data => r -> 'data',
+            p_product_id => r ->> 'product_id',
+            p_product_snapshot_id => (r ->> 'product_snapshot_id')::bigint,
+            p_session_id => p_session_id,
+            p_total => (r ->> 'page')::integer
+        ) AS review_id
+        FROM jsonb_array_elements(p_rows) WITH ORDINALITY AS t(r, ord)
+        ORDER BY ord
+    ) s
+$$;
+
+-- get_latest_snapshots_bulk: snapshot mới nhất của nhiều products (1 RPC / 500 IDs)
+CREATE OR REPLACE FUNCTION raw.get_latest_product_snapshot_ids(p_product_ids text[])
+RETURNS TABLE(product_id text, id bigint)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT ON (pa.product_id) pa.product_id, pa.id
+    FROM raw.product_api pa
+    WHERE pa.product_id = ANY(p_product_ids)
+    ORDER BY pa.product_id, pa.id DESC
+$$;
+
+GRANT EXECUTE ON FUNCTION
+    raw.get_product_ids_for_brands(int[]),
+    raw.safe_upsert_product_api(uuid, text, text, jsonb),
+    raw.safe_insert_products_api_bulk(uuid, text, jsonb),
+    raw.safe_insert_review_api_batch(uuid, text, bigint, jsonb),
+    raw.safe_insert_review_api_rows(uuid, jsonb),
+    raw.get_latest_product_snapshot_ids(text[])
+TO anon, authenticated, service_role;
+
+-- PostgREST reload schema cache → functions mới gọi được ngay
+NOTIFY pgrst, 'reload schema';
@@ -1,18 +1,49 @@
 """
-Supabase client - Match với schema.sql mới
+Supabase client - Match với schema.sql mới + migrations/001_bulk_rpcs.sql (bulk RPCs)
 Incremental snapshot: chỉ lưu khi có thay đổi
 """
 import uuid
+import gzip
 import hashlib
-import json
+import os
 import time
-from typing import Dict, Any, Optional
+import random
+import threading
+from collections import Counter, OrderedDict
+from urllib.parse import urlparse
+import httpx
+import orjson
+from typing import Dict, Any, List, Optional, Tuple
 from supabase import create_client, Client
 
 from logger import setup_logger
 from config import Config
 
 
+class OrjsonHTTPClient(httpx.Client):
+    """
+    httpx.Client encode request body bằng orjson thay vì stdlib json.dumps
+    (postgrest gửi RPC params qua json=...; review pages / product data là JSON lớn, lồng nhiều cấp)
+    orjson ra bytes trực tiếp, nhanh hơn 3-10x → giảm CPU / RPC, không cần đổi call sites
+    gzip_min_bytes: body >= ngưỡng → gzip level 1 (rẻ CPU, JSON giảm ~70-80%), None = không nén
+    """
+    
+    def __init__(self, *args, gzip_min_bytes: Optional[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gzip_min_bytes = gzip_min_bytes
+    
+    def build_request(self, method, url, *, content=None, json=None, headers=None, **kwargs):
+        if json is not None and content is None:
+            content = orjson.dumps(json, option=orjson.OPT_NON_STR_KEYS)
+            json = None
+            headers = httpx.Headers(headers)
+            headers.setdefault('Content-Type', 'application/json')
+            if self.gzip_min_bytes is not None and len(content) >= self.gzip_min_bytes:
+                content = gzip.compress(content, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+        return super().build_request(method, url, content=content, json=json, headers=headers, **kwargs)
+
+
 class SupabaseStorage:
     """
     Supabase storage với incremental snapshot strategy
@@ -20,48 +51,169 @@ class SupabaseStorage:
     - Functions tự động check hash và skip duplicates
     """
     
+    RPC_FAILURE_THRESHOLD = 3  # Batch RPC lỗi liên tiếp trước khi chuyển hẳn sang per-page insert
+    # SQLSTATE classes / PostgREST codes của lỗi tạm thời: connection (08), transaction rollback
+    # (40: deadlock, serialization), insufficient resources (53), operator intervention (57), PGRST00x
+    TRANSIENT_ERROR_CODES = ('08', '40', '53', '57', 'PGRST00')
+    SNAPSHOT_LOOKUP_CHUNK = 500  # Product IDs / 1 bulk snapshot lookup
+    STAT_KEYS = (
+        'home_inserted', 'home_skipped',
+        'listing_inserted', 'listing_skipped',
+        'product_inserted', 'product_skipped',
+        'review_inserted', 'review_skipped',
+        'errors'
+    )
+    
     def __init__(self):
         self.config = Config()
         self.logger = setup_logger()
+        self._http_client: Optional[httpx.Client] = None  # Shared HTTP/2 client (đóng trong close())
         self.client: Client = self._init_client()
         self.session_id: Optional[uuid.UUID] = None
+        self.session_id_str: Optional[str] = None  # Dạng string của session_id (build 1 lần, dùng cho mọi RPC)
+        self._review_batch_failures = 0
+        self._review_rows_failures = 0
+        self._product_bulk_failures = 0
+        self._product_upsert_rpc = True  # False khi DB chưa có safe_upsert_product_api
+        self._snapshot_bulk_rpc = True   # False khi DB chưa có get_latest_product_snapshot_ids
         
-        # Statistics
-        self.stats = {
-            'home_inserted': 0,
-            'home_skipped': 0,
-            'listing_inserted': 0,
-            'listing_skipped': 0,
-            'product_inserted': 0,
-            'product_skipped': 0,
-            'review_inserted': 0,
-            'review_skipped': 0,
-            'errors': 0
-        }
+        # {product_id: snapshot_id mới nhất} - cache snapshot DUY NHẤT (crawler đọc qua cached_snapshot_id)
+        # Write-through: ghi ngay trong lần store / lookup trả về snapshot (LRU, SNAPSHOT_CACHE_MAXSIZE)
+        self._latest_snapshots: "OrderedDict[int, int]" = OrderedDict()
+        self._latest_snapshots_lock = threading.Lock()
+        # {product_id (str): content hash} của data đã lưu thành công (LRU, persist giữa các lần crawl)
+        self._product_hashes: "OrderedDict[str, str]" = OrderedDict()
+        self._product_hashes_lock = threading.Lock()
+        
+        # Statistics: 1 Counter / thread → workers tăng counter không cần lock
+        # get_stats() cộng tất cả Counters lại
+        self._stats_local = threading.local()
+        self._thread_stats: List[Counter] = []
+        self._thread_stats_lock = threading.Lock()  # Chỉ dùng khi thread đăng ký Counter lần đầu
+    
+    @property
+    def stats(self) -> Counter:
+        """Counter của thread hiện tại (tạo lần đầu thread ghi stats)"""
+        counter = getattr(self._stats_local, 'counter', None)
+        if counter is None:
+            # Đủ keys ngay từ đầu → get_stats() đọc từ thread khác không bị đổi size dict
+            counter = Counter(dict.fromkeys(self.STAT_KEYS, 0))
+            self._stats_local.counter = counter
+            with self._thread_stats_lock:
+                self._thread_stats.append(counter)
+        return counter
     
     def _init_client(self) -> Client:
         """Initialize Supabase client"""
         try:
             self.config.validate()
-            from supabase.lib.client_options import ClientOptions
-            
-            options = ClientOptions(
-                schema=self.config.SUPABASE_SCHEMA,
-                auto_refresh_token=False,
-                persist_session=False
-            )
+            options = self._client_options()
+            url = self.config.SUPABASE_POOLER_URL or self.config.SUPABASE_URL
             
             client = create_client(
-                self.config.SUPABASE_URL,
+                url,
                 self.config.SUPABASE_KEY,
                 options=options
             )
-            self.logger.info(f"Supabase client initialized (schema: {self.config.SUPABASE_SCHEMA})")
+            self.logger.info(
+                f"Supabase client initialized (host: {urlparse(url).hostname}, "
+                f"schema: {self.config.SUPABASE_SCHEMA})"
+            )
             return client
         except Exception as e:
             self.logger.error(f"Failed to initialize Supabase: {e}")
             raise
     
+    def _client_options(self):
+        """
+        ClientOptions với 1 httpx.Client HTTP/2 dùng chung cho PostgREST
+        → các worker threads multiplex streams trên ít connections (ít TLS handshake / TIME_WAIT)
+        Request bodies encode bằng orjson (OrjsonHTTPClient)
+        Fallback: supabase-py không hỗ trợ httpx_client → ClientOptions mặc định (HTTP/1.1)
+        """
+        from supabase.lib.client_options import ClientOptions
+        
+        try:
+            from supabase.lib.client_options import SyncClientOptions
+            
+            # Transport tự retry connect errors (an toàn: request chưa được gửi)
+            transport = httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=self.config.DB_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=self.config.DB_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=self.config.DB_HTTP_KEEPALIVE_EXPIRY
+                ),
+                retries=self.config.DB_HTTP_CONNECT_RETRIES
+            )
+            http_client = OrjsonHTTPClient(
+                transport=transport,
+                timeout=self.config.DB_CLIENT_TIMEOUT,
+                gzip_min_bytes=self.config.DB_GZIP_MIN_BYTES if self.config.DB_GZIP_REQUESTS else None
+            )
+            self._http_client = http_client
+            return SyncClientOptions(
+                schema=self.config.SUPABASE_SCHEMA,
+                auto_refresh_token=False,
+                persist_session=False,
+                postgrest_client_timeout=self.config.DB_CLIENT_TIMEOUT,
+                storage_client_timeout=self.config.DB_CLIENT_TIMEOUT,
+                httpx_client=http_client
+            )
+        except (ImportError, TypeError) as e:
+            self.logger.debug(f"HTTP/2 client for Supabase unavailable, using default: {e}")
+            return ClientOptions(
+                schema=self.config.SUPABASE_SCHEMA,
+                auto_refresh_token=False,
+                persist_session=False,
+                postgrest_client_timeout=self.config.DB_CLIENT_TIMEOUT,
+                storage_client_timeout=self.config.DB_CLIENT_TIMEOUT
+            )
+    
+    def close(self):
+        """Đóng shared HTTP/2 client (connections tới PostgREST)"""
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+    
+    def _is_transient_error(self, error: Exception) -> bool:
+        """Lỗi đáng retry: network / timeout (httpx, socket), gateway 5xx hoặc DB code tạm thời"""
+        if isinstance(error, (httpx.TransportError, OSError)):
+            return True
+        code = str(getattr(error, 'code', '') or '')
+        # Response không phải JSON của PostgREST (502/503/504 từ gateway) → code = HTTP status
+        if len(code) == 3 and code.startswith('5') and code.isdigit():
+            return True
+        return code.startswith(self.TRANSIENT_ERROR_CODES)
+    
+    @staticmethod
+    def _is_missing_function(error: Exception) -> bool:
+        """
+        RPC chưa được tạo (chưa chạy migrations/001_bulk_rpcs.sql):
+        PGRST202 - PostgREST không thấy function, 42883 - undefined_function
+        """
+        return str(getattr(error, 'code', '') or '') in ('PGRST202', '42883')
+    
+    def _with_retry(self, operation):
+        """
+        Chạy 1 RPC, retry lỗi transient với exponential backoff + jitter (±50%)
+        ~100ms, 200ms, 400ms... tối đa DB_RETRY_MAX_DELAY; jitter → workers không retry cùng lúc
+        Lỗi khác (payload sai, function không có...) raise ngay, không retry
+        """
+        max_retries = self.config.DB_MAX_RETRIES
+        for attempt in range(max_retries):
+            try:
+                return operation()
+            except Exception as e:
+                if attempt == max_retries - 1 or not self._is_transient_error(e):
+                    raise
+                delay = min(
+                    self.config.DB_RETRY_MAX_DELAY,
+                    self.config.DB_RETRY_BASE_DELAY * (2 ** attempt)
+                ) * random.uniform(0.5, 1.5)
+                self.logger.debug("Transient DB error, retry in %.2fs: %s", delay, e)
+                time.sleep(delay)
+    
     # REMOVED: _calculate_hash()
     # Database triggers handle all hash calculation and deduplication
     # No need for Python to calculate hash (avoids mismatch)
@@ -74,7 +226,9 @@ class SupabaseStorage:
             }).execute()
             
             if result.data:
+                # Validate bằng uuid.UUID 1 lần, cache dạng string cho các RPC sau
                 self.session_id = uuid.UUID(result.data)
+                self.session_id_str = str(self.session_id)
                 self.logger.info(f"Session started: {self.session_id}")
                 return self.session_id
             else:
@@ -97,7 +251,7 @@ class SupabaseStorage:
         
         try:
             self.client.rpc('complete_crawl_session', {
-                'p_session_id': str(self.session_id),
+                'p_session_id': self.session_id_str,
                 'p_status': status
             }).execute()
             
@@ -123,7 +277,7 @@ class SupabaseStorage:
         try:
             # Dùng safe_insert function - tự động handle conflict
             result = self.client.rpc('safe_insert_home_api', {
-                'p_session_id': str(self.session_id),
+                'p_session_id': self.session_id_str,
                 'p_source_name': 'hasaki',
                 'p_data': data
             }).execute()
@@ -147,53 +301,192 @@ class SupabaseStorage:
     def store_product(
         self,
         product_id: int,
-        data: Dict[str, Any]
-    ) -> Optional[int]:
+        data: Dict[str, Any],
+        existing_snapshot_id: Optional[int] = None
+    ) -> Tuple[Optional[int], bool]:
         """
         Lưu Product API data
         Schema mới: CHỈ lưu data + data_hash (không có bought/price)
         Trigger tự động check data_hash để phát hiện thay đổi
-        Returns: product_snapshot_id nếu có thay đổi, None nếu không đổi
+        existing_snapshot_id: snapshot đã biết (get_latest_snapshots_bulk) → không lookup lại khi skipped
+        
+        Client-side short-circuit: content hash trùng lần lưu trước và DB đã có snapshot
+        (existing_snapshot_id) → không gửi RPC (không POST cả JSONB payload chỉ để trigger skip)
+        
+        Returns: (product_snapshot_id, inserted)
+        - inserted=True: snapshot mới
+        - inserted=False: không đổi, snapshot_id = snapshot hiện có (None nếu lỗi / không tìm thấy)
         """
         if not self.session_id:
             self.logger.warning("No active session")
-            return None
+            return None, False
         
-        # Retry logic for Supabase RPC
-        max_retries = 3
-        for attempt in range(max_retries):
+        key = str(product_id)
+        content_hash = self._product_hash(data)
+        if existing_snapshot_id and self._product_hashes.get(key) == content_hash:
+            self.stats['product_skipped'] += 1
+            self.logger.debug("Product skipped (id: %s, unchanged hash)", product_id)
+            return existing_snapshot_id, False
+        
+        try:
+            snapshot_id, inserted = self._with_retry(
+                lambda: self._insert_product(product_id, data, existing_snapshot_id)
+            )
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Failed to store product {product_id}: {e}")
+            return None, False
+        
+        if snapshot_id:
+            self._remember_product_hash(key, content_hash)
+            self._remember_snapshot(product_id, snapshot_id)
+        if inserted:
+            self.stats['product_inserted'] += 1
+            self.logger.debug("Product inserted (id: %s, snapshot: %s)", product_id, snapshot_id)
+        else:
+            # Trigger rejected (no changes)
+            self.stats['product_skipped'] += 1
+            self.logger.debug("Product skipped (id: %s, no changes)", product_id)
+        return snapshot_id, inserted
+    
+    def _insert_product(
+        self,
+        product_id: int,
+        data: Dict[str, Any],
+        existing_snapshot_id: Optional[int] = None
+    ) -> Tuple[Optional[int], bool]:
+        """
+        1 round-trip: RPC safe_upsert_product_api trả về cả snapshot id hiện có khi không đổi
+            raw.safe_upsert_product_api(p_session_id, p_source_name, p_product_id, p_data)
+            RETURNS TABLE(id bigint, inserted boolean)
+        Fallback (function chưa có): safe_insert_product_api + get_latest_product_snapshot_id
+        Raises: lỗi RPC khác → store_product retry
+        """
+        params = {
+            'p_session_id': self.session_id_str,
+            'p_source_name': 'hasaki',
+            'p_product_id': str(product_id),
+            'p_data': data
+        }
+        
+        if self._product_upsert_rpc:
+            try:
+                result = self.client.rpc('safe_upsert_product_api', params).execute()
+                row = result.data[0] if isinstance(result.data, list) and result.data else result.data
+                if row:
+                    return (int(row['id']) if row.get('id') else None), bool(row.get('inserted'))
+                return None, False
+            except Exception as e:
+                error_msg = str(e).lower()
+                if 'does not exist' not in error_msg and 'function' not in error_msg:
+                    raise
+                self._product_upsert_rpc = False
+                self.logger.warning(f"safe_upsert_product_api unavailable, using safe_insert_product_api: {e}")
+        
+        # Function returns id nếu inserted, NULL nếu trigger reject
+        result = self.client.rpc('safe_insert_product_api', params).execute()
+        if result.data:
+            return int(result.data), True
+        return existing_snapshot_id or self.get_latest_product_snapshot_id(product_id), False
+    
+    def store_products(
+        self,
+        items: List[Tuple[int, Dict[str, Any], Optional[int]]]
+    ) -> List[Tuple[Optional[int], bool]]:
+        """
+        Lưu nhiều products trong 1 RPC call (thay vì 1 round-trip / product)
+        items: List of (product_id, data, existing_snapshot_id)
+        
+        RPC safe_insert_products_api_bulk(p_session_id, p_source_name, p_rows)
+        - p_rows: JSONB array [{"product_id": "...", "data": {...}}, ...]
+        - Cùng logic safe_insert_product_api cho từng phần tử (trigger dedup data_hash)
+        - Returns: bigint[] cùng thứ tự p_rows - snapshot id nếu inserted, NULL nếu trigger reject
+        
+        Client-side hash trùng (như store_product) → không gửi trong RPC
+        Lỗi transient → _with_retry (backoff + jitter); vẫn lỗi → store_product từng product
+        Circuit breaker: sau RPC_FAILURE_THRESHOLD lần lỗi non-transient liên tiếp → đi thẳng per-product
+        
+        Returns: [(product_snapshot_id, inserted)] cùng thứ tự items (xem store_product)
+        """
+        if not items:
+            return []
+        if not self.session_id:
+            self.logger.warning("No active session")
+            return [(None, False)] * len(items)
+        
+        results: List[Tuple[Optional[int], bool]] = [(None, False)] * len(items)
+        pending: List[Tuple[int, str]] = []  # (index trong items, content hash) cần gửi RPC
+        for i, (product_id, data, existing_snapshot_id) in enumerate(items):
+            content_hash = self._product_hash(data)
+            if existing_snapshot_id and self._product_hashes.get(str(product_id)) == content_hash:
+                self.stats['product_skipped'] += 1
+                results[i] = (existing_snapshot_id, False)
+            else:
+                pending.append((i, content_hash))
+        
+        if pending and self._product_bulk_failures < self.RPC_FAILURE_THRESHOLD:
             try:
-                # Dùng safe_insert_product_api RPC function
-                result = self.client.rpc('safe_insert_product_api', {
-                    'p_session_id': str(self.session_id),
+                params = {
+                    'p_session_id': self.session_id_str,
                     'p_source_name': 'hasaki',
-                    'p_product_id': str(product_id),
-                    'p_data': data
-                }).execute()
+                    'p_rows': [
+                        {'product_id': str(items[i][0]), 'data': items[i][1]}
+                        for i, _ in pending
+                    ]
+                }
+                result = self._with_retry(
+                    lambda: self.client.rpc('safe_insert_products_api_bulk', params).execute()
+                )
+                snapshot_ids = result.data or []
+                if len(snapshot_ids) != len(pending):
+                    raise ValueError(f"expected {len(pending)} ids, got {len(snapshot_ids)}")
+                self._product_bulk_failures = 0
                 
-                # Function returns id nếu inserted, NULL nếu trigger reject
-                if result.data is not None:
-                    snapshot_id = int(result.data) if result.data else None
+                # Skipped (NULL) → snapshot hiện có: existing_snapshot_id hoặc 1 bulk lookup
+                unknown: List[int] = []
+                for (i, content_hash), snapshot_id in zip(pending, snapshot_ids):
+                    product_id, _, existing_snapshot_id = items[i]
                     if snapshot_id:
                         self.stats['product_inserted'] += 1
-                        self.logger.debug(f"Product inserted (id: {product_id}, snapshot: {snapshot_id})")
-                        return snapshot_id
-                else:
-                    # Trigger rejected (no changes)
-                    self.stats['product_skipped'] += 1
-                    self.logger.debug(f"Product skipped (id: {product_id}, no changes)")
-                    return None
+                        results[i] = (int(snapshot_id), True)
+                    else:
+                        self.stats['product_skipped'] += 1
+                        results[i] = (existing_snapshot_id, False)
+                        if not existing_snapshot_id:
+                            unknown.append(i)
+                
+                if unknown:
+                    latest = self.get_latest_snapshots_bulk(items[i][0] for i in unknown)
+                    for i in unknown:
+                        product_id = items[i][0]
+                        results[i] = (
+                            latest.get(product_id) or self.get_latest_product_snapshot_id(product_id),
+                            False
+                        )
+                
+                for i, content_hash in pending:
+                    if results[i][0]:
+                        self._remember_product_hash(str(items[i][0]), content_hash)
+                        self._remember_snapshot(items[i][0], results[i][0])
+                return results
             
             except Exception as e:
-                if attempt < max_retries - 1:
-                    time.sleep(0.1 * (attempt + 1))
-                    continue
+                # Function chưa có → ngắt luôn; lỗi transient (đã retry hết) không tính vào breaker
+                if self._is_missing_function(e):
+                    self._product_bulk_failures = self.RPC_FAILURE_THRESHOLD
+                elif not self._is_transient_error(e):
+                    self._product_bulk_failures += 1
+                if self._product_bulk_failures == self.RPC_FAILURE_THRESHOLD:
+                    self.logger.warning(
+                        f"safe_insert_products_api_bulk failed {self.RPC_FAILURE_THRESHOLD} times in a row, "
+                        f"using per-product inserts: {e}"
+                    )
                 else:
-                    self.stats['errors'] += 1
-                    self.logger.error(f"Failed to store product {product_id}: {e}")
-                    return None
+                    self.logger.debug(f"Bulk product insert failed ({len(pending)} products), fallback per-product: {e}")
         
-        return None
+        for i, _ in pending:
+            results[i] = self.store_product(*items[i])
+        return results
     
     # REMOVED: _check_review_exists()
     # Database trigger handles all duplicate detection
@@ -223,39 +516,154 @@ class SupabaseStorage:
             self.logger.warning("No active session")
             return None
         
-        # Retry logic for Supabase RPC (handle socket errors)
-        max_retries = 3
-        for attempt in range(max_retries):
+        try:
+            # Schema mới: safe_insert_review_api(p_data, p_product_id, p_product_snapshot_id, p_session_id, p_total)
+            # p_total là page number (field 'pages' trong table)
+            result = self._with_retry(lambda: self.client.rpc('safe_insert_review_api', {
+                'p_data': page_data,
+                'p_product_id': str(product_id),
+                'p_product_snapshot_id': product_snapshot_id,
+                'p_session_id': self.session_id_str,
+                'p_total': page_number  # Page number (1, 2, 3...)
+            }).execute())
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Failed to store review page {page_number} for product {product_id}: {e}")
+            return None
+        
+        # Nếu return NULL = duplicate (trigger reject)
+        if result.data is not None:
+            self.stats['review_inserted'] += 1
+            return 'inserted'
+        else:
+            self.stats['review_skipped'] += 1
+            return 'duplicate'
+    
+    def store_review_pages(
+        self,
+        product_id: int,
+        product_snapshot_id: int,
+        review_pages: List[Tuple[Dict[str, Any], int]]
+    ) -> int:
+        """
+        Lưu nhiều review pages trong 1 RPC call (thay vì 1 round-trip / page)
+        
+        RPC safe_insert_review_api_batch(p_session_id, p_product_id, p_product_snapshot_id, p_pages)
+        - p_pages: JSONB array [{"page": 1, "data": {...}}, ...]
+        - Gọi cùng logic với safe_insert_review_api cho từng phần tử (trigger dedup JSONB)
+        - Returns: INTEGER số pages inserted
+        
+        Fallback: RPC lỗi → store_review_page từng page
+        Circuit breaker: sau RPC_FAILURE_THRESHOLD lần lỗi liên tiếp → đi thẳng per-page
+        
+        Returns: số pages inserted
+        """
+        if not review_pages:
+            return 0
+        if not self.session_id:
+            self.logger.warning("No active session")
+            return 0
+        
+        if self._review_batch_failures < self.RPC_FAILURE_THRESHOLD:
             try:
-                # Schema mới: safe_insert_review_api(p_data, p_product_id, p_product_snapshot_id, p_session_id, p_total)
-                # p_total là page number (field 'pages' trong table)
-                result = self.client.rpc('safe_insert_review_api', {
-                    'p_data': page_data,
+                result = self.client.rpc('safe_insert_review_api_batch', {
+                    'p_session_id': self.session_id_str,
                     'p_product_id': str(product_id),
                     'p_product_snapshot_id': product_snapshot_id,
-                    'p_session_id': str(self.session_id),
-                    'p_total': page_number  # Page number (1, 2, 3...)
+                    'p_pages': [
+                        {'page': page_number, 'data': page_data}
+                        for page_data, page_number in review_pages
+                    ]
                 }).execute()
+                self._review_batch_failures = 0
                 
-                # Nếu return NULL = duplicate (trigger reject)
-                if result.data is not None:
-                    self.stats['review_inserted'] += 1
-                    return 'inserted'
+                inserted = int(result.data or 0)
+                self.stats['review_inserted'] += inserted
+                self.stats['review_skipped'] += len(review_pages) - inserted
+                return inserted
+            
+            except Exception as e:
+                # Function chưa có → ngắt luôn (không thử lại RPC_FAILURE_THRESHOLD lần)
+                self._review_batch_failures = (
+                    self.RPC_FAILURE_THRESHOLD if self._is_missing_function(e)
+                    else self._review_batch_failures + 1
+                )
+                if self._review_batch_failures == self.RPC_FAILURE_THRESHOLD:
+                    self.logger.warning(
+                        f"safe_insert_review_api_batch failed {self.RPC_FAILURE_THRESHOLD} times in a row, "
+                        f"using per-page inserts: {e}"
+                    )
                 else:
-                    self.stats['review_skipped'] += 1
-                    return 'duplicate'
+                    self.logger.debug(f"Batch review insert failed for product {product_id}, fallback per-page: {e}")
+        
+        inserted = 0
+        for page_data, page_number in review_pages:
+            if self.store_review_page(product_id, product_snapshot_id, page_number, page_data) == 'inserted':
+                inserted += 1
+        return inserted
+    
+    def store_review_rows(self, rows: List[Tuple[int, int, int, Dict[str, Any]]]) -> int:
+        """
+        Lưu review pages của NHIỀU products trong 1 RPC call (dùng bởi ReviewBatcher)
+        rows: List of (product_id, product_snapshot_id, page_number, page_data)
+        
+        RPC safe_insert_review_api_rows(p_session_id, p_rows)
+        - p_rows: JSONB array [{"product_id", "product_snapshot_id", "page", "data"}, ...]
+        - Cùng logic safe_insert_review_api cho từng phần tử; Returns: INTEGER số pages inserted
+        
+        Fallback: gom theo product → store_review_pages (tự fallback per-page nếu cần)
+        Returns: số pages inserted
+        """
+        if not rows:
+            return 0
+        if not self.session_id:
+            self.logger.warning("No active session")
+            return 0
+        
+        if self._review_rows_failures < self.RPC_FAILURE_THRESHOLD:
+            try:
+                result = self.client.rpc('safe_insert_review_api_rows', {
+                    'p_session_id': self.session_id_str,
+                    'p_rows': [
+                        {
+                            'product_id': str(product_id),
+                            'product_snapshot_id': snapshot_id,
+                            'page': page_number,
+                            'data': page_data
+                        }
+                        for product_id, snapshot_id, page_number, page_data in rows
+                    ]
+                }).execute()
+                self._review_rows_failures = 0
+                
+                inserted = int(result.data or 0)
+                self.stats['review_inserted'] += inserted
+                self.stats['review_skipped'] += len(rows) - inserted
+                return inserted
             
             except Exception as e:
-                if attempt < max_retries - 1:
-                    time.sleep(0.1 * (attempt + 1))  # 100ms, 200ms delay
-                    continue
+                # Function chưa có → ngắt luôn (không thử lại RPC_FAILURE_THRESHOLD lần)
+                self._review_rows_failures = (
+                    self.RPC_FAILURE_THRESHOLD if self._is_missing_function(e)
+                    else self._review_rows_failures + 1
+                )
+                if self._review_rows_failures == self.RPC_FAILURE_THRESHOLD:
+                    self.logger.warning(
+                        f"safe_insert_review_api_rows failed {self.RPC_FAILURE_THRESHOLD} times in a row, "
+                        f"using per-product inserts: {e}"
+                    )
                 else:
-                    # Final attempt failed
-                    self.stats['errors'] += 1
-                    self.logger.error(f"Failed to store review page {page_number} for product {product_id}: {e}")
-                    return None
+                    self.logger.debug(f"Batch review rows insert failed ({len(rows)} pages), fallback per-product: {e}")
         
-        return None
+        # Gom theo (product, snapshot) giữ nguyên thứ tự pages
+        grouped: Dict[Tuple[int, int], List[Tuple[Dict[str, Any], int]]] = {}
+        for product_id, snapshot_id, page_number, page_data in rows:
+            grouped.setdefault((product_id, snapshot_id), []).append((page_data, page_number))
+        
+        inserted = 0
+        for (product_id, snapshot_id), review_pages in grouped.items():
+            inserted += self.store_review_pages(product_id, snapshot_id, review_pages)
+        return inserted
     
     def store_reviews_for_product(
         self,
@@ -265,9 +673,10 @@ class SupabaseStorage:
     ) -> tuple[int, int]:
         """
         Lưu TOÀN BỘ review pages của product (FULL PAGE JSON)
+        review_pages: List of (page_data, page_number) từ api_client.get_product_reviews
         
         Strategy - Store FULL PAGE JSON:
-        1. Process all pages sequentially  
+        1. Process all pages in one batch RPC (store_review_pages)
         2. Store FULL API response for each page (không tách reviews)
         3. Database trigger handles deduplication by JSONB comparison
         
@@ -285,48 +694,219 @@ class SupabaseStorage:
         if not review_pages:
             return 0, 0
         
+        # Lưu FULL PAGE JSON với page number (1, 2, 3...) - 1 batch RPC
+        # Trigger tự dedup bằng JSONB comparison
         total_crawled = len(review_pages)
-        total_inserted = 0
-        
-        for page_data, metadata, page_number in review_pages:
-            # Lưu FULL PAGE JSON với page number (1, 2, 3...)
-            # Trigger tự dedup bằng JSONB comparison
-            result = self.store_review_page(
-                product_id, 
-                product_snapshot_id,
-                page_number,  # Page number để track
-                page_data     # Full JSON response
-            )
-            
-            if result == 'inserted':
-                total_inserted += 1
-            
+        total_inserted = self.store_review_pages(product_id, product_snapshot_id, review_pages)
+        
         return total_crawled, total_inserted
     
     def get_latest_product_snapshot_id(self, product_id: int) -> Optional[int]:
         """
         Lấy product_snapshot_id mới nhất của product
+        Cache hit (store / lookup trước) → không cần RPC; miss → RPC rồi ghi vào cache
         """
-        # Retry logic for Supabase RPC
-        max_retries = 3
-        for attempt in range(max_retries):
+        snapshot_id = self.cached_snapshot_id(product_id)
+        if snapshot_id is not None:
+            return snapshot_id
+        
+        try:
+            result = self._with_retry(lambda: self.client.rpc('get_latest_product_snapshot_id', {
+                'p_product_id': str(product_id)
+            }).execute())
+        except Exception as e:
+            self.logger.error(f"Failed to get snapshot id for product {product_id}: {e}")
+            return None
+        
+        if result.data:
+            self._remember_snapshot(product_id, result.data)
+            return result.data
+        return None
+    
+    def cached_snapshot_id(self, product_id: int) -> Optional[int]:
+        """Snapshot mới nhất từ cache (không gọi RPC), None nếu chưa biết"""
+        with self._latest_snapshots_lock:
+            snapshot_id = self._latest_snapshots.get(product_id)
+            if snapshot_id is not None:
+                self._latest_snapshots.move_to_end(product_id)
+            return snapshot_id
+    
+    def _remember_snapshot(self, product_id: int, snapshot_id: int):
+        """Ghi snapshot mới nhất của product vào cache, evict LRU khi vượt SNAPSHOT_CACHE_MAXSIZE"""
+        with self._latest_snapshots_lock:
+            self._latest_snapshots[product_id] = snapshot_id
+            self._latest_snapshots.move_to_end(product_id)
+            if len(self._latest_snapshots) > self.config.SNAPSHOT_CACHE_MAXSIZE:
+                self._latest_snapshots.popitem(last=False)
+    
+    def get_latest_snapshots_bulk(self, product_ids) -> Dict[int, int]:
+        """
+        Lấy product_snapshot_id mới nhất cho nhiều products (1 RPC / SNAPSHOT_LOOKUP_CHUNK IDs)
+            raw.get_latest_product_snapshot_ids(p_product_ids text[])
+            RETURNS TABLE(product_id text, id bigint)  -- DISTINCT ON (product_id) ... ORDER BY id DESC
+        Kết quả được ghi vào snapshot cache (cached_snapshot_id / get_latest_product_snapshot_id)
+        Lỗi → trả phần đã lấy được; caller fallback get_latest_product_snapshot_id
+        Function chưa có → không gọi lại trong cả run
+        Returns: {product_id: snapshot_id}
+        """
+        snapshots: Dict[int, int] = {}
+        if not self._snapshot_bulk_rpc:
+            return snapshots
+        ids = [str(pid) for pid in product_ids]
+        
+        for start in range(0, len(ids), self.SNAPSHOT_LOOKUP_CHUNK):
+            chunk = ids[start:start + self.SNAPSHOT_LOOKUP_CHUNK]
             try:
-                result = self.client.rpc('get_latest_product_snapshot_id', {
-                    'p_product_id': str(product_id)
+                result = self.client.rpc('get_latest_product_snapshot_ids', {
+                    'p_product_ids': chunk
                 }).execute()
-                
-                return result.data if result.data else None
-            
             except Exception as e:
-                if attempt < max_retries - 1:
-                    time.sleep(0.1 * (attempt + 1))
-                    continue
-                else:
-                    self.logger.error(f"Failed to get snapshot id for product {product_id}: {e}")
-                    return None
+                if self._is_missing_function(e):
+                    self._snapshot_bulk_rpc = False
+                self.logger.warning(f"Bulk snapshot lookup failed, fallback per-product lookups: {e}")
+                return snapshots
+            
+            for row in result.data or []:
+                if row.get('id'):
+                    product_id, snapshot_id = int(row['product_id']), int(row['id'])
+                    snapshots[product_id] = snapshot_id
+                    self._remember_snapshot(product_id, snapshot_id)
         
-        return None
+        return snapshots
+    
+    @staticmethod
+    def _product_hash(data: Dict[str, Any]) -> str:
+        """Hash nội dung product data (keys sorted → không phụ thuộc thứ tự keys trong response)"""
+        return hashlib.blake2b(
+            orjson.dumps(data, option=orjson.OPT_SORT_KEYS),
+            digest_size=16
+        ).hexdigest()
+    
+    def _remember_product_hash(self, key: str, content_hash: str):
+        """Lưu hash của product vừa store, evict LRU khi vượt PRODUCT_HASH_MAXSIZE"""
+        with self._product_hashes_lock:
+            self._product_hashes[key] = content_hash
+            self._product_hashes.move_to_end(key)
+            if len(self._product_hashes) > self.config.PRODUCT_HASH_MAXSIZE:
+                self._product_hashes.popitem(last=False)
+    
+    def load_product_hashes(self):
+        """Load product content hashes từ lần crawl trước (Config.PRODUCT_HASHES_FILE)"""
+        path = self.config.PRODUCT_HASHES_FILE
+        try:
+            if not path.exists():
+                return
+            with open(path, 'rb') as f:
+                self._product_hashes = OrderedDict(orjson.loads(f.read()))
+            self.logger.debug(f"Loaded {len(self._product_hashes)} product hashes from {path}")
+        except Exception as e:
+            self.logger.warning(f"Failed to load product hashes: {e}")
+            self._product_hashes = OrderedDict()
+    
+    def save_product_hashes(self):
+        """
+        Persist product content hashes cho lần crawl sau
+        Ghi file tạm rồi os.replace (atomic) → run bị kill giữa chừng không để lại file hỏng
+        """
+        path = self.config.PRODUCT_HASHES_FILE
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._product_hashes_lock:
+                snapshot = orjson.dumps(self._product_hashes)
+            tmp_path = path.with_suffix(path.suffix + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(snapshot)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.logger.warning(f"Failed to save product hashes: {e}")
     
     def get_stats(self) -> Dict[str, int]:
-        """Lấy statistics"""
-        return self.stats.copy()
+        """Lấy statistics (tổng của tất cả threads)"""
+        total = dict.fromkeys(self.STAT_KEYS, 0)
+        with self._thread_stats_lock:
+            counters = list(self._thread_stats)
+        for counter in counters:
+            for key in self.STAT_KEYS:
+                total[key] += counter[key]
+        return total
+
+
+class ReviewBatcher:
+    """
+    Gom review pages của nhiều products → 1 RPC / FLUSH_ROWS pages (hoặc mỗi FLUSH_INTERVAL giây)
+    Thread-safe: review workers add_many(), background thread flush định kỳ
+    Kết quả insert được cộng vào storage stats (review_inserted / review_skipped)
+    flush() / close() đợi cả các lần store đang chạy trên threads khác → stats đầy đủ khi return
+    """
+    
+    FLUSH_ROWS = 200       # Pages / 1 RPC (giữ request body vừa phải: mỗi page là full JSON response)
+    FLUSH_INTERVAL = 2.0   # Giây - flush phần còn lại khi ít products đang ra reviews
+    
+    def __init__(self, storage: SupabaseStorage):
+        self.storage = storage
+        self.logger = storage.logger
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # notify khi không còn store in-flight
+        self._inflight = 0
+        self._buf: List[Tuple[int, int, int, Dict[str, Any]]] = []
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically,
+            name="review-batcher",
+            daemon=True
+        )
+        self._flusher.start()
+    
+    def add_many(self, product_id: int, snapshot_id: int, review_pages: List[Tuple[Dict[str, Any], int]]):
+        """Thêm pages của 1 product; đủ FLUSH_ROWS → flush ngay trên thread gọi"""
+        rows = [
+            (product_id, snapshot_id, page_number, page_data)
+            for page_data, page_number in review_pages
+        ]
+        with self._lock:
+            self._buf.extend(rows)
+            if len(self._buf) < self.FLUSH_ROWS:
+                return
+            rows = self._take()
+        self._store(rows)
+    
+    def flush(self):
+        """Lưu tất cả pages còn trong buffer, đợi các lần store in-flight (threads khác) xong"""
+        with self._lock:
+            rows = self._take()
+        self._store(rows)
+        with self._idle:
+            while self._inflight:
+                self._idle.wait()
+    
+    def close(self):
+        """Dừng + join background flusher rồi lưu phần còn lại (idempotent)"""
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+    
+    def _take(self) -> List[Tuple[int, int, int, Dict[str, Any]]]:
+        """Lấy hết buffer (gọi khi đang giữ _lock); đánh dấu 1 store in-flight nếu có rows"""
+        rows, self._buf = self._buf, []
+        if rows:
+            self._inflight += 1
+        return rows
+    
+    def _store(self, rows: List[Tuple[int, int, int, Dict[str, Any]]]):
+        if not rows:
+            return
+        try:
+            self.storage.store_review_rows(rows)
+        except Exception as e:
+            self.storage.stats['errors'] += 1
+            self.logger.error(f"Failed to store {len(rows)} review pages: {e}")
+        finally:
+            with self._idle:
+                self._inflight -= 1
+                self._idle.notify_all()
+    
+    def _flush_periodically(self):
+        while not self._stop.wait(self.FLUSH_INTERVAL):
+            with self._lock:
+                rows = self._take()
+            self._store(rows)